@@ -1,9 +1,42 @@
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, render_template, request, redirect, url_for, session, g, Response, send_from_directory, send_file, abort, flash, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+import click
 import os
+import sys
+import json
+import atexit
+import time
+import hashlib
+import hmac
+import shutil
+import http.client
+import queue
+import random
+import secrets
+import sqlite3
+import smtplib
+import socketserver
+import multiprocessing
+from collections import Counter, OrderedDict
+from io import BytesIO
+from urllib.parse import quote, urlsplit
+from email.message import EmailMessage
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import wraps
+from datetime import date, datetime, timedelta
 from threading import Lock
+from sqlalchemy import Delete, Insert, Update, event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import selectinload
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.datastructures import CallbackDict
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'change-this-secret-key')
@@ -20,17 +53,117 @@ if database_url:
     app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(db_dir, 'eee_learnhub.db')
+# Read replicas get their own binds; no model is mapped to them, so create_all()
+# never touches them and only routed reads use them.
+replica_urls = [
+    url.strip().replace('postgres://', 'postgresql://', 1)
+    for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()
+]
+REPLICA_BIND_KEYS = [f'replica{i}' for i in range(len(replica_urls))]
+app.config['SQLALCHEMY_BINDS'] = dict(zip(REPLICA_BIND_KEYS, replica_urls))
+app.config['READ_YOUR_WRITES_SECONDS'] = float(os.getenv('READ_YOUR_WRITES_SECONDS', '5'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = os.path.join(app.static_folder, 'uploads', 'notes')
-app.config['INTERVIEW_UPLOAD_FOLDER'] = os.path.join(app.static_folder, 'uploads', 'interview')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB
-
-db = SQLAlchemy(app)
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.getenv('STATIC_MAX_AGE', '3600'))
+app.config['STORAGE_BACKEND'] = os.getenv('STORAGE_BACKEND', 'local')
+app.config['STORAGE_LOCAL_DIR'] = os.getenv('STORAGE_LOCAL_DIR', os.path.join(db_dir, 'storage'))
+app.config['S3_ENDPOINT_URL'] = os.getenv('S3_ENDPOINT_URL', 'https://s3.amazonaws.com')
+app.config['S3_BUCKET'] = os.getenv('S3_BUCKET', '')
+app.config['S3_REGION'] = os.getenv('S3_REGION', 'us-east-1')
+app.config['S3_ACCESS_KEY_ID'] = os.getenv('S3_ACCESS_KEY_ID', '')
+app.config['S3_SECRET_ACCESS_KEY'] = os.getenv('S3_SECRET_ACCESS_KEY', '')
+app.config['S3_PREFIX'] = os.getenv('S3_PREFIX', '')
+app.config['STORAGE_URL_EXPIRES'] = int(os.getenv('STORAGE_URL_EXPIRES', '300'))
+app.config['STORAGE_CACHE_DIR'] = os.getenv('STORAGE_CACHE_DIR', os.path.join(db_dir, 'file-cache'))
+app.config['STORAGE_CACHE_MAX_MB'] = int(os.getenv('STORAGE_CACHE_MAX_MB', '512'))
+app.config['STORAGE_CACHE_HOT_HITS'] = int(os.getenv('STORAGE_CACHE_HOT_HITS', '3'))
+app.config['CERTIFICATE_WORKERS'] = int(os.getenv('CERTIFICATE_WORKERS', '1'))
+app.config['METRICS_DIR'] = os.getenv('METRICS_DIR', os.path.join(db_dir, 'metrics'))
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN', '')
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.getenv('METRICS_FLUSH_INTERVAL', '1.0'))
+app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', os.path.join(db_dir, 'profiles'))
+app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+app.config['PROFILE_INTERVAL'] = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+app.config['PROFILE_MAX_FILES'] = int(os.getenv('PROFILE_MAX_FILES', '200'))
+app.config['SESSION_BACKEND'] = os.getenv('SESSION_BACKEND', 'database')
+app.config['SESSION_SQLITE_PATH'] = os.getenv('SESSION_SQLITE_PATH', os.path.join(db_dir, 'sessions.db'))
+app.config['SESSION_CACHE_SIZE'] = int(os.getenv('SESSION_CACHE_SIZE', '2000'))
+app.config['SESSION_CACHE_SECONDS'] = float(os.getenv('SESSION_CACHE_SECONDS', '5'))
+app.config['SESSION_SWEEP_INTERVAL'] = int(os.getenv('SESSION_SWEEP_INTERVAL', '3600'))
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+app.config['RATE_LIMIT_ENABLED'] = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+app.config['RATE_LIMIT_STORE'] = os.getenv('RATE_LIMIT_STORE', '')
+app.config['RATE_LIMIT_TRUST_PROXY'] = os.getenv('RATE_LIMIT_TRUST_PROXY', '0') == '1'
+app.config['RATE_LIMITS'] = {
+    'login_ip': os.getenv('RATE_LIMIT_LOGIN_IP', '20/60'),
+    'login_account': os.getenv('RATE_LIMIT_LOGIN_ACCOUNT', '5/60'),
+    'register_ip': os.getenv('RATE_LIMIT_REGISTER_IP', '5/300'),
+    'admin_login_ip': os.getenv('RATE_LIMIT_ADMIN_LOGIN_IP', '5/60'),
+}
+app.config['BADGE_CACHE_SECONDS'] = float(os.getenv('BADGE_CACHE_SECONDS', '0'))
+app.config['EVENTS_POLL_INTERVAL'] = float(os.getenv('EVENTS_POLL_INTERVAL', '0.5'))
+app.config['WEB_THREADS'] = int(os.getenv('WEB_THREADS', '16'))
+app.config['EVENTS_RESERVED_THREADS'] = int(os.getenv('EVENTS_RESERVED_THREADS', '6'))
+# Every open /events stream holds a gthread worker thread, so streams may only
+# use the threads left after the reserved pool for ordinary requests.
+events_thread_budget = max(app.config['WEB_THREADS'] - app.config['EVENTS_RESERVED_THREADS'], 0)
+app.config['EVENTS_MAX_CONNECTIONS'] = min(
+    int(os.getenv('EVENTS_MAX_CONNECTIONS', str(events_thread_budget))), events_thread_budget
+)
+app.config['EVENTS_MAX_PER_USER'] = int(os.getenv('EVENTS_MAX_PER_USER', '2'))
+# A request waiting on a password hash holds its thread too, so hash jobs may
+# take at most half of the reserved threads and pages keep the rest.
+password_hash_thread_budget = max(app.config['EVENTS_RESERVED_THREADS'] // 2, 1)
+app.config['PASSWORD_HASH_QUEUE'] = min(
+    int(os.getenv('PASSWORD_HASH_QUEUE', str(password_hash_thread_budget))), password_hash_thread_budget
+)
+app.config['EVENTS_RETRY_SECONDS'] = int(os.getenv('EVENTS_RETRY_SECONDS', '30'))
+app.config['EVENTS_STREAM_SECONDS'] = int(os.getenv('EVENTS_STREAM_SECONDS', '300'))
+app.config['EVENTS_RETENTION_MINUTES'] = int(os.getenv('EVENTS_RETENTION_MINUTES', '60'))
+app.config['PROGRESS_BUFFER_ENABLED'] = os.getenv('PROGRESS_BUFFER_ENABLED', '0') == '1'
+app.config['PROGRESS_FLUSH_MS'] = int(os.getenv('PROGRESS_FLUSH_MS', '250'))
+app.config['PROGRESS_FLUSH_EVENTS'] = int(os.getenv('PROGRESS_FLUSH_EVENTS', '200'))
+app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', '')
+app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', '587'))
+app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME', '')
+app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD', '')
+app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', '1') == '1'
+app.config['MAIL_SENDER'] = os.getenv('MAIL_SENDER', 'EEE LearnHub <no-reply@localhost>')
+app.config['MAIL_DISPATCH_IN_WEB'] = os.getenv('MAIL_DISPATCH_IN_WEB', '1') == '1'
+app.config['MAIL_BATCH_SIZE'] = int(os.getenv('MAIL_BATCH_SIZE', '50'))
+app.config['MAIL_SEND_RATE'] = float(os.getenv('MAIL_SEND_RATE', '5'))
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.getenv('MAIL_MAX_ATTEMPTS', '5'))
+app.config['MAIL_RETRY_SECONDS'] = int(os.getenv('MAIL_RETRY_SECONDS', '60'))
+app.config['MAIL_POLL_INTERVAL'] = float(os.getenv('MAIL_POLL_INTERVAL', '5'))
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores ON DELETE CASCADE unless foreign keys are switched on per connection.
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+class RoutingSession(FlaskSQLAlchemySession):
+    # Statements go to the primary unless the current request opted into a
+    # replica via @read_replica; flushes and DML always use the primary.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            replica_key = g.get('db_replica')
+            if replica_key and not isinstance(clause, (Insert, Update, Delete)):
+                return self._db.engines[replica_key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 db_init_lock = Lock()
 db_bootstrapped = False
 
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['INTERVIEW_UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
 
 
 # ==================== MODELS ====================
@@ -39,7 +172,7 @@ class Subject(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
 
-    topics = db.relationship('Topic', backref='subject', lazy=True, cascade='all, delete-orphan')
+    topics = db.relationship('Topic', backref='subject', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f'<Subject {self.name}>'
@@ -48,11 +181,11 @@ class Subject(db.Model):
 class Topic(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
-    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id', ondelete='CASCADE'), nullable=False)
 
-    videos = db.relationship('Video', backref='topic', lazy=True, cascade='all, delete-orphan')
-    notes = db.relationship('Note', backref='topic', lazy=True, cascade='all, delete-orphan')
-    questions = db.relationship('Question', backref='topic', lazy=True, cascade='all, delete-orphan')
+    videos = db.relationship('Video', backref='topic', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    notes = db.relationship('Note', backref='topic', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    questions = db.relationship('Question', backref='topic', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f'<Topic {self.name}>'
@@ -62,7 +195,7 @@ class Video(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     youtube_id = db.Column(db.String(50), nullable=False)
-    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), nullable=False)
+    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id', ondelete='CASCADE'), nullable=False)
 
     def __repr__(self):
         return f'<Video {self.title}>'
@@ -72,7 +205,7 @@ class Note(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     file_path = db.Column(db.String(300), nullable=False)
-    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), nullable=False)
+    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id', ondelete='CASCADE'), nullable=False)
 
     def __repr__(self):
         return f'<Note {self.title}>'
@@ -81,7 +214,14 @@ class Note(db.Model):
 class Question(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String(300), nullable=False)
-    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), nullable=False)
+    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id', ondelete='CASCADE'), nullable=False)
+    # Optional answer key: JSON list of choices and the 0-based correct index.
+    choices = db.Column(db.Text, nullable=True)
+    answer = db.Column(db.Integer, nullable=True)
+
+    @property
+    def choice_list(self):
+        return json.loads(self.choices) if self.choices else []
 
     def __repr__(self):
         return f'<Question {self.text[:30]}>'
@@ -93,52 +233,217 @@ class User(db.Model):
     email = db.Column(db.String(120), nullable=False, unique=True)
     password_hash = db.Column(db.String(200), nullable=False)
     last_seen_admin_message_id = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
 
     def __repr__(self):
         return f'<User {self.email}>'
 
 
+# TopicCompletion/SubjectCompletion are derived from VideoCompletion: a row
+# exists while the user has completed every video in the topic/subject.
+# They are kept in sync by the helpers in the PROGRESS section.
 class TopicCompletion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), nullable=False)
+    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id', ondelete='CASCADE'), nullable=False)
+
+    __table_args__ = (db.Index('ix_topic_completion_user_topic', 'user_id', 'topic_id'),)
+
+
+class SubjectCompletion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id', ondelete='CASCADE'), nullable=False)
+
+    __table_args__ = (db.Index('ix_subject_completion_user_subject', 'user_id', 'subject_id'),)
 
 
 class VideoCompletion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id', ondelete='CASCADE'), nullable=False)
+    completed_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
 
+    __table_args__ = (db.Index('ix_video_completion_user_video', 'user_id', 'video_id'),)
 
-class Message(db.Model):
+
+# A QuizSet is an immutable, pre-shuffled snapshot of a topic's quiz
+# questions (with their answer keys), so grading never touches Question.
+class QuizSet(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id', ondelete='CASCADE'), nullable=False, index=True)
+    items = db.Column(db.Text, nullable=False)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class QuizAttempt(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    quiz_set_id = db.Column(db.Integer, db.ForeignKey('quiz_set.id', ondelete='CASCADE'), nullable=False, index=True)
+    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id', ondelete='CASCADE'), nullable=False)
+    score = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.Integer, nullable=False)
+    answers = db.Column(db.Text, nullable=False)
+    submitted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class QuestionStat(db.Model):
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id', ondelete='CASCADE'), primary_key=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    correct = db.Column(db.Integer, nullable=False, default=0)
+
+
+# One row per (user, subject, version); version is the subject's video count
+# when it was completed. file_path points at a content-addressed PDF.
+class Certificate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id', ondelete='CASCADE'), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    file_path = db.Column(db.String(300), nullable=True)
+    issued_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('user_id', 'subject_id', 'version', name='uq_certificate_version'),)
+
+
+# Append-only log of catalog (subject/topic/video/note/question) changes.
+# version is the sync version, taken from catalog_version. op is 'upsert' or
+# 'delete'.
+class CatalogChange(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(10), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=True, index=True)
+
+    __table_args__ = (db.Index('ix_catalog_change_entity', 'entity', 'entity_id'),)
+
+
+# Single-row counter that hands out catalog versions. Bumping it locks the row
+# until the writer commits, so versions become visible in order and a reader
+# can never see version N+1 while N is still uncommitted.
+class CatalogVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Each compaction records the highest version whose delete entries may have
+# been dropped; clients syncing from before it must start over.
+class CatalogCompaction(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    horizon = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# Analytics rollups, maintained incrementally from completion events.
+# scope is 'video', 'topic', 'subject' or 'students' (scope_id 0).
+class CompletionRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(10), nullable=False)
+    scope_id = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.UniqueConstraint('scope', 'scope_id', name='uq_completion_rollup_scope'),)
+
+
+class DailyRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    metric = db.Column(db.String(30), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.UniqueConstraint('day', 'metric', name='uq_daily_rollup_day_metric'),)
+
+
+class Message(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user_name = db.Column(db.String(100), nullable=False)
     user_email = db.Column(db.String(120), nullable=False)
     text = db.Column(db.String(500), nullable=False)
     sender = db.Column(db.String(20), nullable=False, default='student')
 
+    __table_args__ = (db.Index('ix_message_user_id_id', 'user_id', 'id'),)
+
+
+class Cohort(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+
+    members = db.relationship('CohortMember', backref='cohort', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+
+
+class CohortMember(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cohort_id = db.Column(db.Integer, db.ForeignKey('cohort.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+
 
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     body = db.Column(db.String(800), nullable=False)
+    # 'all' = broadcast, 'cohort' = members of cohort_id, 'users' = NotificationRecipient rows
+    audience = db.Column(db.String(10), nullable=False, default='all', server_default='all', index=True)
+    cohort_id = db.Column(db.Integer, db.ForeignKey('cohort.id'), nullable=True, index=True)
+
+
+class NotificationRecipient(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    notification_id = db.Column(db.Integer, db.ForeignKey('notification.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
 
 
 class NotificationRead(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    notification_id = db.Column(db.Integer, db.ForeignKey('notification.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    notification_id = db.Column(db.Integer, db.ForeignKey('notification.id', ondelete='CASCADE'), nullable=False, index=True)
 
 
 class InterviewPrep(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id', ondelete='CASCADE'), nullable=False)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.String(1200), nullable=False)
     pdf_path = db.Column(db.String(300), nullable=True)
 
 
+class SessionRecord(db.Model):
+    id = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=True, index=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class LiveEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    cohort_id = db.Column(db.Integer, db.ForeignKey('cohort.id'), nullable=True)
+    kind = db.Column(db.String(30), nullable=False)
+    payload = db.Column(db.String(1000), nullable=False, default='{}')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+# Outbound mail queue: one row per (notification, student), drained by the
+# mail dispatcher. status is pending, sending, sent or failed.
+class OutboundEmail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    notification_id = db.Column(db.Integer, db.ForeignKey('notification.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claim = db.Column(db.String(32), nullable=True, index=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(300), nullable=True)
+
+    __table_args__ = (db.Index('ix_outbound_email_due', 'status', 'next_attempt_at'),)
+
+
 # ==================== SEED DATA ====================
 
 def seed_data():
@@ -405,6 +710,29 @@ def seed_data():
     db.session.commit()
 
 
+def upgrade_schema():
+    # create_all() only creates missing tables; add any new columns and
+    # indexes to tables that already exist so older databases keep working.
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(db.engine.dialect)}'
+                if column.server_default is not None:
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                conn.execute(text(ddl))
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn, checkfirst=True)
+
+
 def ensure_database_initialized():
     global db_bootstrapped
     if db_bootstrapped:
@@ -415,13 +743,1195 @@ def ensure_database_initialized():
             return
         try:
             with app.app_context():
+                existing_tables = set(inspect(db.engine).get_table_names())
                 db.create_all()
+                upgrade_schema()
+                init_catalog_version()
                 seed_data()
+                if 'subject_completion' not in existing_tables:
+                    rebuild_completions()
+                    db.session.commit()
+                if 'completion_rollup' not in existing_tables:
+                    backfill_analytics()
+                    db.session.commit()
+                if 'catalog_change' not in existing_tables:
+                    backfill_catalog_changes()
+                    db.session.commit()
             db_bootstrapped = True
         except Exception:
             app.logger.exception('Database initialization failed')
 
 
+# ==================== PROGRESS ====================
+
+def _completed_video_count(user_id, video_filter):
+    return db.session.query(db.func.count(db.distinct(VideoCompletion.video_id))).join(
+        Video, Video.id == VideoCompletion.video_id
+    ).filter(VideoCompletion.user_id == user_id, video_filter).scalar() or 0
+
+
+def _set_completion(model, column, scope, user_id, target_id, complete):
+    existing = model.query.filter(model.user_id == user_id, column == target_id)
+    if complete:
+        if not existing.first():
+            db.session.add(model(user_id=user_id, **{column.key: target_id}))
+            bump_rollup(scope, target_id, 1)
+            bump_daily(f'{scope}_completions', 1)
+            if scope == 'subject':
+                queue_certificate(user_id, target_id)
+    else:
+        removed = existing.delete(synchronize_session=False)
+        if removed:
+            bump_rollup(scope, target_id, -removed)
+
+
+def sync_user_completion(user_id, topic_id):
+    # Re-derive one user's topic and subject completion after they (un)complete
+    # a video; the caller commits both in the same transaction.
+    topic = db.session.get(Topic, topic_id)
+    if topic is None:
+        return
+    total = Video.query.filter_by(topic_id=topic_id).count()
+    done = _completed_video_count(user_id, Video.topic_id == topic_id)
+    _set_completion(TopicCompletion, TopicCompletion.topic_id, 'topic', user_id, topic_id, total > 0 and done >= total)
+
+    subject_videos = Video.topic_id.in_(db.select(Topic.id).where(Topic.subject_id == topic.subject_id))
+    total = Video.query.filter(subject_videos).count()
+    done = _completed_video_count(user_id, subject_videos)
+    _set_completion(
+        SubjectCompletion, SubjectCompletion.subject_id, 'subject',
+        user_id, topic.subject_id, total > 0 and done >= total
+    )
+
+
+def _resync_completions(model, column, scope, target_id, video_filter):
+    model.query.filter(column == target_id).delete(synchronize_session=False)
+    total = Video.query.filter(video_filter).count()
+    if total == 0:
+        set_rollup(scope, target_id, 0)
+        return
+    completed_users = db.select(VideoCompletion.user_id, db.literal(target_id)).join(
+        Video, Video.id == VideoCompletion.video_id
+    ).where(video_filter).group_by(VideoCompletion.user_id).having(
+        db.func.count(db.distinct(VideoCompletion.video_id)) >= total
+    )
+    db.session.execute(db.insert(model).from_select(['user_id', column.key], completed_users))
+    set_rollup(scope, target_id, model.query.filter(column == target_id).count())
+
+
+def resync_subject_completions(subject_id):
+    subject_videos = Video.topic_id.in_(db.select(Topic.id).where(Topic.subject_id == subject_id))
+    _resync_completions(SubjectCompletion, SubjectCompletion.subject_id, 'subject', subject_id, subject_videos)
+
+
+def resync_topic_completions(topic_id, subject_id):
+    # Set-based re-derivation for every user after the admin adds or removes
+    # videos; the caller commits.
+    db.session.flush()
+    _resync_completions(TopicCompletion, TopicCompletion.topic_id, 'topic', topic_id, Video.topic_id == topic_id)
+    resync_subject_completions(subject_id)
+
+
+def rebuild_completions():
+    for topic_id, subject_id in db.session.query(Topic.id, Topic.subject_id).all():
+        _resync_completions(TopicCompletion, TopicCompletion.topic_id, 'topic', topic_id, Video.topic_id == topic_id)
+    for (subject_id,) in db.session.query(Subject.id).all():
+        resync_subject_completions(subject_id)
+
+
+def subject_progress(user_id, subjects):
+    totals = dict(db.session.query(Topic.subject_id, db.func.count(Video.id)).join(
+        Video, Video.topic_id == Topic.id
+    ).group_by(Topic.subject_id).all())
+    completed = dict(db.session.query(Topic.subject_id, db.func.count(db.distinct(VideoCompletion.video_id))).join(
+        Video, Video.topic_id == Topic.id
+    ).join(
+        VideoCompletion, VideoCompletion.video_id == Video.id
+    ).filter(VideoCompletion.user_id == user_id).group_by(Topic.subject_id).all())
+
+    for _, _, subject_id, delta in pending_progress_deltas(user_id):
+        completed[subject_id] = completed.get(subject_id, 0) + delta
+
+    progress = {}
+    for subject in subjects:
+        total_videos = totals.get(subject.id, 0)
+        completed_count = completed.get(subject.id, 0)
+        percent = 0
+        if total_videos > 0:
+            percent = int((completed_count / total_videos) * 100)
+        progress[subject.id] = {
+            'completed': completed_count,
+            'total': total_videos,
+            'percent': percent
+        }
+    return progress
+
+
+def pending_progress_deltas(user_id):
+    # Buffered events that would change this user's stored progress, as
+    # (video_id, topic_id, subject_id, +1/-1), so reads can include them.
+    pending = pending_progress(user_id)
+    if not pending:
+        return []
+    done = {
+        video_id for (video_id,) in db.session.query(VideoCompletion.video_id).filter(
+            VideoCompletion.user_id == user_id,
+            VideoCompletion.video_id.in_(list(pending))
+        )
+    }
+    return [
+        (video_id, topic_id, subject_id, 1 if completed else -1)
+        for video_id, (completed, topic_id, subject_id) in pending.items()
+        if completed != (video_id in done)
+    ]
+
+
+@app.cli.command('rebuild-completions')
+def rebuild_completions_command():
+    rebuild_completions()
+    db.session.commit()
+    print('Topic and subject completions rebuilt.')
+
+
+# ==================== PROGRESS BUFFER ====================
+
+# Optional write-behind buffer for video (un)completions. Clicks are coalesced
+# per (user, video) in this worker -- the last click wins -- and written by a
+# background thread every PROGRESS_FLUSH_MS or once PROGRESS_FLUSH_EVENTS are
+# waiting, in one transaction with batched inserts/deletes. Reads merge in the
+# caller's pending events via pending_progress_deltas().
+progress_buffer = {}
+progress_buffer_size = 0
+progress_buffer_cond = threading.Condition()
+progress_flusher_started = False
+
+
+def buffer_progress(user_id, events):
+    global progress_buffer_size
+    with progress_buffer_cond:
+        pending = progress_buffer.setdefault(user_id, {})
+        for video_id, topic_id, subject_id, completed in events:
+            if video_id not in pending:
+                progress_buffer_size += 1
+            pending[video_id] = (completed, topic_id, subject_id)
+        if progress_buffer_size >= app.config['PROGRESS_FLUSH_EVENTS']:
+            progress_buffer_cond.notify()
+    ensure_progress_flusher()
+
+
+def pending_progress(user_id):
+    if not app.config['PROGRESS_BUFFER_ENABLED']:
+        return {}
+    with progress_buffer_cond:
+        return dict(progress_buffer.get(user_id, ()))
+
+
+def _apply_progress_events(batch):
+    video_ids = {video_id for events in batch.values() for video_id in events}
+    video_topics = dict(db.session.query(Video.id, Video.topic_id).filter(Video.id.in_(video_ids)))
+    done = set(db.session.query(VideoCompletion.user_id, VideoCompletion.video_id).filter(
+        VideoCompletion.user_id.in_(list(batch)),
+        VideoCompletion.video_id.in_(video_ids)
+    ))
+    inserts, deletes, touched = [], [], set()
+    video_delta = Counter()
+    now = datetime.utcnow()
+    for user_id, events in batch.items():
+        for video_id, (completed, _, _) in events.items():
+            topic_id = video_topics.get(video_id)
+            if topic_id is None or completed == ((user_id, video_id) in done):
+                continue
+            if completed:
+                inserts.append({'user_id': user_id, 'video_id': video_id, 'completed_at': now})
+                video_delta[video_id] += 1
+            else:
+                deletes.append({'uid': user_id, 'vid': video_id})
+                video_delta[video_id] -= 1
+            touched.add((user_id, topic_id))
+
+    completions = VideoCompletion.__table__
+    if inserts:
+        db.session.execute(completions.insert(), inserts)
+        bump_daily('video_completions', len(inserts))
+    if deletes:
+        db.session.execute(completions.delete().where(
+            completions.c.user_id == db.bindparam('uid'),
+            completions.c.video_id == db.bindparam('vid')
+        ), deletes)
+        bump_daily('video_uncompletions', len(deletes))
+    for video_id, delta in video_delta.items():
+        if delta:
+            bump_rollup('video', video_id, delta)
+    for user_id, topic_id in touched:
+        sync_user_completion(user_id, topic_id)
+
+
+def flush_progress_buffer():
+    global progress_buffer, progress_buffer_size
+    with progress_buffer_cond:
+        batch = progress_buffer
+        progress_buffer, progress_buffer_size = {}, 0
+    if not batch:
+        return
+    try:
+        with app.app_context():
+            try:
+                _apply_progress_events(batch)
+                db.session.commit()
+                submit_new_certificates()
+            except Exception:
+                db.session.rollback()
+                g.pop('new_certificates', None)
+                raise
+    except OperationalError:
+        # Usually a locked or briefly unavailable database: put the events
+        # back (newer clicks win) and try again on the next tick.
+        app.logger.exception('Progress flush failed; retrying')
+        with progress_buffer_cond:
+            for user_id, events in batch.items():
+                pending = progress_buffer.setdefault(user_id, {})
+                for video_id, value in events.items():
+                    if video_id not in pending:
+                        pending[video_id] = value
+                        progress_buffer_size += 1
+    except Exception:
+        app.logger.exception('Progress flush failed; dropped %d users\' events', len(batch))
+
+
+def _run_progress_flusher():
+    interval = app.config['PROGRESS_FLUSH_MS'] / 1000.0
+    while True:
+        with progress_buffer_cond:
+            progress_buffer_cond.wait_for(
+                lambda: progress_buffer_size >= app.config['PROGRESS_FLUSH_EVENTS'], timeout=interval
+            )
+        flush_progress_buffer()
+
+
+def ensure_progress_flusher():
+    global progress_flusher_started
+    if progress_flusher_started:
+        return
+    with progress_buffer_cond:
+        if progress_flusher_started:
+            return
+        threading.Thread(target=_run_progress_flusher, name='progress-flusher', daemon=True).start()
+        progress_flusher_started = True
+
+
+if app.config['PROGRESS_BUFFER_ENABLED']:
+    # Gunicorn workers exit through sys.exit on a graceful shutdown, so this
+    # writes out whatever is still buffered.
+    atexit.register(flush_progress_buffer)
+
+
+# ==================== ANALYTICS ====================
+
+def _bump(model, filters, delta):
+    updated = model.query.filter_by(**filters).update(
+        {model.count: model.count + delta}, synchronize_session=False
+    )
+    if updated:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(count=delta, **filters))
+    except IntegrityError:
+        # Another request created the row first; apply the delta to it.
+        model.query.filter_by(**filters).update({model.count: model.count + delta}, synchronize_session=False)
+
+
+def bump_rollup(scope, scope_id, delta):
+    _bump(CompletionRollup, {'scope': scope, 'scope_id': scope_id}, delta)
+
+
+def bump_daily(metric, delta, day=None):
+    # Days are UTC, like the timestamps backfill_analytics groups by.
+    _bump(DailyRollup, {'day': day or datetime.utcnow().date(), 'metric': metric}, delta)
+
+
+def set_rollup(scope, scope_id, value):
+    updated = CompletionRollup.query.filter_by(scope=scope, scope_id=scope_id).update(
+        {CompletionRollup.count: value}, synchronize_session=False
+    )
+    if not updated:
+        db.session.add(CompletionRollup(scope=scope, scope_id=scope_id, count=value))
+
+
+def drop_rollups(scope, scope_ids):
+    CompletionRollup.query.filter(
+        CompletionRollup.scope == scope,
+        CompletionRollup.scope_id.in_(scope_ids)
+    ).delete(synchronize_session=False)
+
+
+def backfill_analytics():
+    CompletionRollup.query.delete(synchronize_session=False)
+    DailyRollup.query.delete(synchronize_session=False)
+    rollups = [
+        ('video', db.session.query(VideoCompletion.video_id, db.func.count(db.distinct(VideoCompletion.user_id))).join(
+            Video, Video.id == VideoCompletion.video_id
+        ).group_by(VideoCompletion.video_id)),
+        ('topic', db.session.query(TopicCompletion.topic_id, db.func.count(TopicCompletion.id)).group_by(TopicCompletion.topic_id)),
+        ('subject', db.session.query(SubjectCompletion.subject_id, db.func.count(SubjectCompletion.id)).group_by(SubjectCompletion.subject_id)),
+    ]
+    for scope, query in rollups:
+        for scope_id, count in query.all():
+            db.session.add(CompletionRollup(scope=scope, scope_id=scope_id, count=count))
+    db.session.add(CompletionRollup(scope='students', scope_id=0, count=User.query.count()))
+
+    def add_daily(metric, rows):
+        days = Counter()
+        for day, count in rows:
+            if day is None:
+                continue
+            if isinstance(day, str):
+                day = date.fromisoformat(day[:10])
+            elif isinstance(day, datetime):
+                day = day.date()
+            days[day] += count
+        for day, count in days.items():
+            db.session.add(DailyRollup(day=day, metric=metric, count=count))
+
+    def per_day(column, count_column):
+        day = db.func.date(column)
+        return db.session.query(day, db.func.count(count_column)).filter(column.isnot(None)).group_by(day).all()
+
+    add_daily('video_completions', per_day(VideoCompletion.completed_at, VideoCompletion.id))
+    add_daily('registrations', per_day(User.created_at, User.id))
+    add_daily('quiz_attempts', per_day(QuizAttempt.submitted_at, QuizAttempt.id))
+
+    # A topic or subject was completed when its last video was.
+    topic_done = db.session.query(db.func.max(VideoCompletion.completed_at)).join(
+        Video, Video.id == VideoCompletion.video_id
+    ).join(TopicCompletion, db.and_(
+        TopicCompletion.topic_id == Video.topic_id, TopicCompletion.user_id == VideoCompletion.user_id
+    )).group_by(TopicCompletion.id)
+    add_daily('topic_completions', ((done, 1) for (done,) in topic_done.all()))
+    subject_done = db.session.query(db.func.max(VideoCompletion.completed_at)).join(
+        Video, Video.id == VideoCompletion.video_id
+    ).join(Topic, Topic.id == Video.topic_id).join(SubjectCompletion, db.and_(
+        SubjectCompletion.subject_id == Topic.subject_id, SubjectCompletion.user_id == VideoCompletion.user_id
+    )).group_by(SubjectCompletion.id)
+    add_daily('subject_completions', ((done, 1) for (done,) in subject_done.all()))
+
+
+def analytics_summary(days=30):
+    counts = {(r.scope, r.scope_id): r.count for r in CompletionRollup.query.all()}
+    students = counts.get(('students', 0), 0)
+
+    def rate(count):
+        return round(count * 100.0 / students, 1) if students else 0.0
+
+    subjects = []
+    topics = Topic.query.order_by(Topic.name).all()
+    videos = Video.query.order_by(Video.id).all()
+    for subject in Subject.query.order_by(Subject.name).all():
+        subject_count = counts.get(('subject', subject.id), 0)
+        topic_rows = []
+        for topic in (t for t in topics if t.subject_id == subject.id):
+            topic_count = counts.get(('topic', topic.id), 0)
+            video_rows = [
+                {'id': v.id, 'title': v.title, 'completions': counts.get(('video', v.id), 0),
+                 'rate': rate(counts.get(('video', v.id), 0))}
+                for v in videos if v.topic_id == topic.id
+            ]
+            topic_rows.append({'id': topic.id, 'name': topic.name, 'completions': topic_count,
+                               'rate': rate(topic_count), 'videos': video_rows})
+        subjects.append({'id': subject.id, 'name': subject.name, 'completions': subject_count,
+                         'rate': rate(subject_count), 'topics': topic_rows})
+
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    daily = {}
+    for row in DailyRollup.query.filter(DailyRollup.day >= since).order_by(DailyRollup.day).all():
+        daily.setdefault(row.day.isoformat(), {})[row.metric] = row.count
+
+    return {'students': students, 'subjects': subjects, 'daily': daily}
+
+
+@app.cli.command('backfill-analytics')
+def backfill_analytics_command():
+    backfill_analytics()
+    db.session.commit()
+    print('Analytics rollups rebuilt.')
+
+
+# ==================== QUIZZES ====================
+
+QUIZ_SET_CACHE_SIZE = 500
+
+quiz_set_cache = OrderedDict()
+quiz_set_cache_lock = Lock()
+
+
+def parse_question_choices(form):
+    choices = [line.strip() for line in form.get('question_choices', '').splitlines() if line.strip()]
+    answer = form.get('question_answer', type=int)
+    if len(choices) < 2 or answer is None or not 1 <= answer <= len(choices):
+        return None, None
+    return json.dumps(choices), answer - 1
+
+
+def generate_quiz_sets(topic_id, count, size):
+    questions = Question.query.filter(
+        Question.topic_id == topic_id,
+        Question.choices.isnot(None),
+        Question.answer.isnot(None)
+    ).all()
+    if not questions:
+        return 0
+    size = min(size, len(questions)) if size else len(questions)
+    for _ in range(count):
+        items = []
+        for question in random.sample(questions, size):
+            order = list(range(len(question.choice_list)))
+            random.shuffle(order)
+            items.append({
+                'question_id': question.id,
+                'text': question.text,
+                'choices': question.choice_list,
+                'order': order,
+                'answer': question.answer,
+            })
+        db.session.add(QuizSet(topic_id=topic_id, items=json.dumps(items)))
+    existing = {qid for (qid,) in db.session.query(QuestionStat.question_id).filter(
+        QuestionStat.question_id.in_([q.id for q in questions])
+    )}
+    for question in questions:
+        if question.id not in existing:
+            db.session.add(QuestionStat(question_id=question.id, attempts=0, correct=0))
+    return count
+
+
+def load_quiz_set(quiz_set_id):
+    # Quiz sets never change after creation, so each worker can keep them.
+    with quiz_set_cache_lock:
+        cached = quiz_set_cache.get(quiz_set_id)
+        if cached is not None:
+            quiz_set_cache.move_to_end(quiz_set_id)
+    record_cache_lookup('quiz_set', cached is not None)
+    if cached is not None:
+        return cached
+    quiz_set = db.session.get(QuizSet, quiz_set_id)
+    if quiz_set is None:
+        return None
+    cached = {'id': quiz_set.id, 'topic_id': quiz_set.topic_id, 'items': json.loads(quiz_set.items)}
+    with quiz_set_cache_lock:
+        quiz_set_cache[quiz_set_id] = cached
+        while len(quiz_set_cache) > QUIZ_SET_CACHE_SIZE:
+            quiz_set_cache.popitem(last=False)
+    return cached
+
+
+def grade_quiz(quiz_set, form):
+    answers = {}
+    results = []
+    score = 0
+    for item in quiz_set['items']:
+        chosen = form.get(f"q{item['question_id']}", type=int)
+        correct = chosen is not None and chosen == item['answer']
+        score += 1 if correct else 0
+        answers[str(item['question_id'])] = chosen
+        results.append({'question_id': item['question_id'], 'chosen': chosen, 'correct': correct})
+    return score, answers, results
+
+
+def record_quiz_attempt(user_id, quiz_set, score, answers, results):
+    # One INSERT for the attempt plus one executemany for the per-question
+    # counters, committed together.
+    db.session.add(QuizAttempt(
+        user_id=user_id,
+        quiz_set_id=quiz_set['id'],
+        topic_id=quiz_set['topic_id'],
+        score=score,
+        total=len(quiz_set['items']),
+        answers=json.dumps(answers)
+    ))
+    if results:
+        stats = QuestionStat.__table__
+        db.session.execute(
+            stats.update().where(stats.c.question_id == db.bindparam('qid')).values(
+                attempts=stats.c.attempts + 1,
+                correct=stats.c.correct + db.bindparam('hit')
+            ),
+            [{'qid': r['question_id'], 'hit': 1 if r['correct'] else 0} for r in results]
+        )
+    bump_daily('quiz_attempts', 1)
+
+
+# ==================== FILE STORAGE ====================
+
+# Uploaded PDFs and certificates live behind a storage driver, keyed by a
+# path such as uploads/notes/<token>/<file>.pdf. The local driver keeps the
+# files in STORAGE_LOCAL_DIR, outside static/, so they are only reachable
+# through the login-checked /files/ route (files uploaded under static/ by
+# older versions are still read from there); the S3 driver talks to any S3-compatible
+# service (AWS, MinIO, ...) using SigV4, so every web node sees the same
+# files. Keys are never reused, which keeps the per-node read-through cache
+# coherent without revalidation.
+STORAGE_HIT_TRACK_SIZE = 10000
+
+storage_hits = OrderedDict()
+storage_hits_lock = Lock()
+
+
+def _inline_download(key):
+    # Notes and interview PDFs open in the browser's viewer as they always
+    # have; certificates are saved as files.
+    return key.startswith('uploads/') and key.lower().endswith('.pdf')
+
+
+def _file_response(response):
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+class LocalStorage:
+    def __init__(self, root, legacy_root=None):
+        self.root = root
+        self.legacy_root = legacy_root
+
+    def _root_for(self, key):
+        if self.legacy_root and not os.path.exists(os.path.join(self.root, *key.split('/'))):
+            if os.path.exists(os.path.join(self.legacy_root, *key.split('/'))):
+                return self.legacy_root
+        return self.root
+
+    def _path(self, key):
+        return os.path.join(self._root_for(key), *key.split('/'))
+
+    def save(self, key, stream):
+        path = os.path.join(self.root, *key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{secrets.token_hex(4)}.tmp'
+        with open(tmp_path, 'wb') as fh:
+            shutil.copyfileobj(stream, fh, 64 * 1024)
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+    def delete(self, key):
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def response(self, key):
+        return _file_response(send_from_directory(self._root_for(key), key, as_attachment=not _inline_download(key)))
+
+
+class S3Storage:
+    def __init__(self, endpoint, bucket, region, access_key, secret_key, prefix=''):
+        parts = urlsplit(endpoint)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.base = parts.geturl().rstrip('/')
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.prefix = prefix
+
+    def _uri(self, key):
+        return '/' + quote(f'{self.bucket}/{self.prefix}{key}', safe='/-_.~')
+
+    def _signature(self, method, uri, query, headers, payload_hash, stamp):
+        canonical_query = '&'.join(
+            f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}" for k, v in sorted(query.items())
+        )
+        signed_headers = ';'.join(sorted(headers))
+        canonical_headers = ''.join(f'{name}:{headers[name]}\n' for name in sorted(headers))
+        canonical_request = '\n'.join([method, uri, canonical_query, canonical_headers, signed_headers, payload_hash])
+        scope = f'{stamp[:8]}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', stamp, scope, hashlib.sha256(canonical_request.encode()).hexdigest()
+        ])
+        signing_key = f'AWS4{self.secret_key}'.encode()
+        for part in (stamp[:8], self.region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return scope, signed_headers, canonical_query, signature
+
+    def _request(self, method, key, body=None, length=0):
+        uri = self._uri(key)
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        headers = {'host': self.host, 'x-amz-content-sha256': 'UNSIGNED-PAYLOAD', 'x-amz-date': stamp}
+        scope, signed_headers, _, signature = self._signature(method, uri, {}, headers, 'UNSIGNED-PAYLOAD', stamp)
+        headers['authorization'] = (
+            f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+            f'SignedHeaders={signed_headers}, Signature={signature}'
+        )
+        if body is not None:
+            headers['content-length'] = str(length)
+        connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        conn = connection_class(self.host, timeout=30)
+        conn.request(method, uri, body=body, headers=headers)
+        return conn, conn.getresponse()
+
+    def _call(self, method, key, ok, body=None, length=0):
+        conn, resp = self._request(method, key, body, length)
+        try:
+            resp.read()
+            if resp.status not in ok:
+                raise OSError(f'S3 {method} {key} failed with HTTP {resp.status}')
+            return resp.status
+        finally:
+            conn.close()
+
+    def save(self, key, stream):
+        # Streams the spooled upload straight into the PUT body.
+        stream.seek(0, os.SEEK_END)
+        length = stream.tell()
+        stream.seek(0)
+        self._call('PUT', key, (200,), body=stream, length=length)
+        return length
+
+    def _cache_path(self, key):
+        return os.path.join(
+            app.config['STORAGE_CACHE_DIR'],
+            hashlib.sha256(key.encode()).hexdigest() + os.path.splitext(key)[1]
+        )
+
+    def delete(self, key):
+        self._call('DELETE', key, (200, 204, 404))
+        cache_path = self._cache_path(key)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+    def exists(self, key):
+        return self._call('HEAD', key, (200, 404)) == 200
+
+    def download(self, key, path):
+        conn, resp = self._request('GET', key)
+        try:
+            if resp.status != 200:
+                raise OSError(f'S3 GET {key} failed with HTTP {resp.status}')
+            with open(path, 'wb') as fh:
+                shutil.copyfileobj(resp, fh, 64 * 1024)
+        finally:
+            conn.close()
+
+    def signed_url(self, key, expires):
+        uri = self._uri(key)
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        query = {
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f'{self.access_key}/{stamp[:8]}/{self.region}/s3/aws4_request',
+            'X-Amz-Date': stamp,
+            'X-Amz-Expires': str(expires),
+            'X-Amz-SignedHeaders': 'host',
+            'response-content-disposition': '{}; filename="{}"'.format(
+                'inline' if _inline_download(key) else 'attachment', key.rsplit('/', 1)[-1]
+            ),
+        }
+        _, _, canonical_query, signature = self._signature(
+            'GET', uri, query, {'host': self.host}, 'UNSIGNED-PAYLOAD', stamp
+        )
+        return f'{self.base}{uri}?{canonical_query}&X-Amz-Signature={signature}'
+
+    def response(self, key):
+        cache_path = self._cache_path(key)
+        if os.path.exists(cache_path):
+            record_cache_lookup('file', True)
+            os.utime(cache_path)
+            return self._send_cached(cache_path, key)
+        record_cache_lookup('file', False)
+        # Cold files are served straight from the bucket; once a file has been
+        # asked for a few times on this node it is pulled into the local cache.
+        if _count_storage_hit(key) < app.config['STORAGE_CACHE_HOT_HITS']:
+            return redirect(self.signed_url(key, app.config['STORAGE_URL_EXPIRES']))
+        tmp_path = f'{cache_path}.{secrets.token_hex(4)}.tmp'
+        self.download(key, tmp_path)
+        os.replace(tmp_path, cache_path)
+        _trim_storage_cache()
+        return self._send_cached(cache_path, key)
+
+    def _send_cached(self, cache_path, key):
+        return _file_response(send_file(
+            cache_path, as_attachment=not _inline_download(key), download_name=key.rsplit('/', 1)[-1]
+        ))
+
+
+def _count_storage_hit(key):
+    with storage_hits_lock:
+        hits = storage_hits.pop(key, 0) + 1
+        storage_hits[key] = hits
+        while len(storage_hits) > STORAGE_HIT_TRACK_SIZE:
+            storage_hits.popitem(last=False)
+    return hits
+
+
+def _trim_storage_cache():
+    limit = app.config['STORAGE_CACHE_MAX_MB'] * 1024 * 1024
+    entries = []
+    total = 0
+    for entry in os.scandir(app.config['STORAGE_CACHE_DIR']):
+        if entry.is_file() and not entry.name.endswith('.tmp'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def new_storage_key(folder, filename):
+    return f'{folder}/{secrets.token_hex(8)}/{filename}'
+
+
+def save_upload(file, folder, kind):
+    key = new_storage_key(folder, secure_filename(file.filename) or 'upload.pdf')
+    size = storage.save(key, file.stream)
+    metrics_inc('upload_bytes_total', size, kind=kind)
+    return key
+
+
+def remove_stored_files(keys):
+    for key in keys:
+        if not key:
+            continue
+        try:
+            storage.delete(key)
+        except OSError:
+            app.logger.exception('Could not delete stored file %s', key)
+
+
+if app.config['STORAGE_BACKEND'] == 's3':
+    storage = S3Storage(
+        app.config['S3_ENDPOINT_URL'], app.config['S3_BUCKET'], app.config['S3_REGION'],
+        app.config['S3_ACCESS_KEY_ID'], app.config['S3_SECRET_ACCESS_KEY'], app.config['S3_PREFIX']
+    )
+    os.makedirs(app.config['STORAGE_CACHE_DIR'], exist_ok=True)
+else:
+    storage = LocalStorage(app.config['STORAGE_LOCAL_DIR'], legacy_root=app.static_folder)
+    os.makedirs(app.config['STORAGE_LOCAL_DIR'], exist_ok=True)
+
+
+@app.cli.command('move-local-files')
+def move_local_files_command():
+    # Moves files uploaded under static/ by older versions into STORAGE_LOCAL_DIR.
+    if not isinstance(storage, LocalStorage):
+        print('move-local-files only applies to STORAGE_BACKEND=local.')
+        return
+    moved = 0
+    for folder in ('uploads', 'certificates'):
+        source_root = os.path.join(app.static_folder, folder)
+        for dirpath, _, filenames in os.walk(source_root):
+            for filename in filenames:
+                source = os.path.join(dirpath, filename)
+                target = os.path.join(storage.root, os.path.relpath(source, app.static_folder))
+                if os.path.exists(target):
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(source, target)
+                moved += 1
+    print(f'Moved {moved} files into {storage.root}.')
+
+
+# ==================== CERTIFICATES ====================
+
+# PDFs are rendered in a small process pool (created lazily, after gunicorn
+# forks) so a class finishing together queues up there instead of burning
+# web-worker CPU. The pool uses forkserver/spawn, since forking a threaded
+# gthread worker can copy held locks into the child. Each PDF is stored under
+# a random key, and a certificate's version is a hash of the subject's video
+# ids, so any change to the lesson list issues a new one.
+certificate_pool = None
+certificate_pool_lock = Lock()
+certificates_in_flight = set()
+
+
+def _pdf_escape(value):
+    return value.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def render_certificate_pdf(student_name, subject_name, issued_on, video_count):
+    lines = [
+        (421, 430, 34, 'Certificate of Completion'),
+        (421, 370, 14, 'This certifies that'),
+        (421, 325, 28, student_name),
+        (421, 280, 14, 'has completed every lesson in'),
+        (421, 238, 24, subject_name),
+        (421, 195, 12, f'{video_count} video lectures - EEE LearnHub'),
+        (421, 120, 12, f'Issued on {issued_on}'),
+    ]
+    commands = ['2 w 30 30 782 535 re S', '0.5 w 40 40 762 515 re S']
+    for center_x, y, size, value in lines:
+        # Helvetica averages ~0.5em per glyph; good enough to centre a line.
+        x = max(center_x - len(value) * size * 0.25, 50)
+        commands.append(f'BT /F1 {size} Tf {x:.1f} {y} Td ({_pdf_escape(value)}) Tj ET')
+    stream = '\n'.join(commands).encode('latin-1', 'replace')
+
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 842 595] '
+        b'/Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>',
+        b'<< /Length ' + str(len(stream)).encode() + b' >>\nstream\n' + stream + b'\nendstream',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+    ]
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f'{number} 0 obj\n'.encode() + body + b'\nendobj\n'
+    xref_at = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    for offset in offsets:
+        out += f'{offset:010d} 00000 n \n'.encode()
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n'.encode()
+    return bytes(out)
+
+
+def _get_certificate_pool():
+    global certificate_pool
+    with certificate_pool_lock:
+        if certificate_pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            certificate_pool = ProcessPoolExecutor(max_workers=app.config['CERTIFICATE_WORKERS'], mp_context=context)
+        return certificate_pool
+
+
+def _discard_certificate_pool(pool):
+    global certificate_pool
+    with certificate_pool_lock:
+        if certificate_pool is pool:
+            certificate_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit_render(*args):
+    pool = _get_certificate_pool()
+    try:
+        return pool.submit(render_certificate_pdf, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory) and the executor refuses all
+        # further work; replace it once rather than failing every request.
+        _discard_certificate_pool(pool)
+        return _get_certificate_pool().submit(render_certificate_pdf, *args)
+
+
+def _store_certificate(certificate_id, future):
+    try:
+        pdf = future.result()
+        key = new_storage_key('certificates', f'certificate-{certificate_id}.pdf')
+        storage.save(key, BytesIO(pdf))
+        with app.app_context():
+            certificate = db.session.get(Certificate, certificate_id)
+            if certificate is not None:
+                certificate.status = 'ready'
+                certificate.file_path = key
+                db.session.commit()
+    except Exception:
+        app.logger.exception('Certificate rendering failed')
+    finally:
+        certificates_in_flight.discard(certificate_id)
+
+
+def _subject_video_ids(subject_id):
+    return db.session.scalars(
+        db.select(Video.id).join(Topic, Topic.id == Video.topic_id).where(Topic.subject_id == subject_id).order_by(Video.id)
+    ).all()
+
+
+def certificate_version(video_ids):
+    # 31 bits of a hash of the lesson list; fits the integer column everywhere.
+    digest = hashlib.sha256(','.join(str(i) for i in video_ids).encode()).digest()
+    return int.from_bytes(digest[:4], 'big') & 0x7fffffff
+
+
+def submit_certificate(certificate):
+    if certificate.id in certificates_in_flight:
+        return
+    args = (
+        db.session.get(User, certificate.user_id).name,
+        db.session.get(Subject, certificate.subject_id).name,
+        certificate.issued_at.strftime('%d %B %Y'),
+        len(_subject_video_ids(certificate.subject_id))
+    )
+    certificates_in_flight.add(certificate.id)
+    try:
+        future = _submit_render(*args)
+    except Exception:
+        certificates_in_flight.discard(certificate.id)
+        raise
+    future.add_done_callback(lambda f, cid=certificate.id: _store_certificate(cid, f))
+
+
+def queue_certificate(user_id, subject_id):
+    version = certificate_version(_subject_video_ids(subject_id))
+    certificate = Certificate.query.filter_by(user_id=user_id, subject_id=subject_id, version=version).first()
+    if certificate is None:
+        certificate = Certificate(user_id=user_id, subject_id=subject_id, version=version)
+        db.session.add(certificate)
+        g.setdefault('new_certificates', []).append(certificate)
+    return certificate
+
+
+def submit_new_certificates():
+    for certificate in g.pop('new_certificates', None) or ():
+        if certificate.id is None:
+            continue
+        try:
+            submit_certificate(certificate)
+        except Exception:
+            app.logger.exception('Could not queue certificate rendering')
+
+
+@app.teardown_request
+def dispatch_new_certificates(exc):
+    # Render only once the completion that earned the certificate is committed.
+    if exc is not None:
+        g.pop('new_certificates', None)
+        return
+    submit_new_certificates()
+
+
+# ==================== CONTENT DELETION ====================
+
+# Deletes are issued as a handful of set-based statements, children first, so
+# removing a large subject never loads its rows into the session. The foreign
+# keys also carry ON DELETE CASCADE, but databases created before that have
+# no cascade, so these helpers do not rely on it.
+
+def delete_videos(video_ids):
+    log_catalog_deletes('video', video_ids)
+    VideoCompletion.query.filter(VideoCompletion.video_id.in_(video_ids)).delete(synchronize_session=False)
+    drop_rollups('video', video_ids)
+    Video.query.filter(Video.id.in_(video_ids)).delete(synchronize_session=False)
+
+
+def delete_questions(question_ids):
+    log_catalog_deletes('question', question_ids)
+    QuestionStat.query.filter(QuestionStat.question_id.in_(question_ids)).delete(synchronize_session=False)
+    Question.query.filter(Question.id.in_(question_ids)).delete(synchronize_session=False)
+
+
+def delete_topics(topic_ids):
+    delete_videos(db.select(Video.id).where(Video.topic_id.in_(topic_ids)))
+    delete_questions(db.select(Question.id).where(Question.topic_id.in_(topic_ids)))
+    note_paths = db.session.execute(db.select(Note.file_path).where(Note.topic_id.in_(topic_ids))).scalars().all()
+    log_catalog_deletes('note', db.select(Note.id).where(Note.topic_id.in_(topic_ids)))
+    log_catalog_deletes('topic', topic_ids)
+    Note.query.filter(Note.topic_id.in_(topic_ids)).delete(synchronize_session=False)
+    QuizAttempt.query.filter(QuizAttempt.topic_id.in_(topic_ids)).delete(synchronize_session=False)
+    QuizSet.query.filter(QuizSet.topic_id.in_(topic_ids)).delete(synchronize_session=False)
+    TopicCompletion.query.filter(TopicCompletion.topic_id.in_(topic_ids)).delete(synchronize_session=False)
+    drop_rollups('topic', topic_ids)
+    Topic.query.filter(Topic.id.in_(topic_ids)).delete(synchronize_session=False)
+    return note_paths
+
+
+def delete_subject_content(subject_id):
+    note_paths = delete_topics(db.select(Topic.id).where(Topic.subject_id == subject_id))
+    pdf_paths = db.session.execute(
+        db.select(InterviewPrep.pdf_path).where(InterviewPrep.subject_id == subject_id)
+    ).scalars().all()
+    InterviewPrep.query.filter_by(subject_id=subject_id).delete(synchronize_session=False)
+    SubjectCompletion.query.filter_by(subject_id=subject_id).delete(synchronize_session=False)
+    Certificate.query.filter_by(subject_id=subject_id).delete(synchronize_session=False)
+    drop_rollups('subject', [subject_id])
+    log_catalog_deletes('subject', [subject_id])
+    Subject.query.filter_by(id=subject_id).delete(synchronize_session=False)
+    return note_paths + pdf_paths
+
+
+def delete_notifications(notification_ids):
+    NotificationRead.query.filter(NotificationRead.notification_id.in_(notification_ids)).delete(synchronize_session=False)
+    NotificationRecipient.query.filter(
+        NotificationRecipient.notification_id.in_(notification_ids)
+    ).delete(synchronize_session=False)
+    OutboundEmail.query.filter(OutboundEmail.notification_id.in_(notification_ids)).delete(synchronize_session=False)
+    Notification.query.filter(Notification.id.in_(notification_ids)).delete(synchronize_session=False)
+
+
+def purge_orphans():
+    # Clears rows left behind by deletes made before these helpers existed.
+    removed = 0
+    orphan_checks = [
+        (VideoCompletion, VideoCompletion.video_id, Video.id),
+        (TopicCompletion, TopicCompletion.topic_id, Topic.id),
+        (SubjectCompletion, SubjectCompletion.subject_id, Subject.id),
+        (InterviewPrep, InterviewPrep.subject_id, Subject.id),
+        (Certificate, Certificate.subject_id, Subject.id),
+        (QuestionStat, QuestionStat.question_id, Question.id),
+        (QuizAttempt, QuizAttempt.topic_id, Topic.id),
+        (QuizSet, QuizSet.topic_id, Topic.id),
+        (NotificationRead, NotificationRead.notification_id, Notification.id),
+        (NotificationRecipient, NotificationRecipient.notification_id, Notification.id),
+    ]
+    for model, column, parent_id in orphan_checks:
+        removed += model.query.filter(~column.in_(db.select(parent_id))).delete(synchronize_session=False)
+    for scope, parent_id in (('video', Video.id), ('topic', Topic.id), ('subject', Subject.id)):
+        removed += CompletionRollup.query.filter(
+            CompletionRollup.scope == scope,
+            ~CompletionRollup.scope_id.in_(db.select(parent_id))
+        ).delete(synchronize_session=False)
+    return removed
+
+
+@app.cli.command('purge-orphans')
+def purge_orphans_command():
+    removed = purge_orphans()
+    db.session.commit()
+    print(f'Removed {removed} orphaned rows.')
+
+
+# ==================== CATALOG SYNC ====================
+
+# Every catalog mutation appends to catalog_change: ORM inserts, updates and
+# deletes through the flush hook below, set-based deletes through
+# log_catalog_deletes(). /api/catalog/changes?since=<version> replays the log
+# so clients sync in O(changes); since=0 returns the whole catalog.
+CATALOG_MODELS = {'subject': Subject, 'topic': Topic, 'video': Video, 'note': Note, 'question': Question}
+CATALOG_ENTITIES = {model: name for name, model in CATALOG_MODELS.items()}
+CATALOG_PAGE_SIZE = 500
+
+
+def init_catalog_version():
+    # Entries logged before catalog_version existed keep their id as version.
+    CatalogChange.query.filter(CatalogChange.version.is_(None)).update(
+        {CatalogChange.version: CatalogChange.id}, synchronize_session=False
+    )
+    if db.session.get(CatalogVersion, 1) is None:
+        current = db.session.query(db.func.max(CatalogChange.version)).scalar() or 0
+        db.session.add(CatalogVersion(id=1, version=current))
+    db.session.commit()
+
+
+def _insert_catalog_changes(connection, entries):
+    if not entries:
+        return
+    counter = CatalogVersion.__table__
+    connection.execute(counter.update().where(counter.c.id == 1).values(version=counter.c.version + len(entries)))
+    last = connection.execute(db.select(counter.c.version).where(counter.c.id == 1)).scalar()
+    now = datetime.utcnow()
+    connection.execute(CatalogChange.__table__.insert(), [
+        {'entity': entity, 'entity_id': entity_id, 'op': op, 'created_at': now, 'version': version}
+        for (entity, entity_id, op), version in zip(entries, range(last - len(entries) + 1, last + 1))
+    ])
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def log_catalog_flush(session, flush_context):
+    entries = []
+    for op, objects in (('upsert', session.new), ('upsert', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            entity = CATALOG_ENTITIES.get(type(obj))
+            if entity is None or (op == 'upsert' and obj in session.dirty and not session.is_modified(obj)):
+                continue
+            entries.append((entity, obj.id, op))
+    _insert_catalog_changes(session.connection(), entries)
+
+
+def log_catalog_deletes(entity, ids):
+    model = CATALOG_MODELS[entity]
+    if isinstance(ids, (list, tuple, set)):
+        ids = db.select(model.id).where(model.id.in_(list(ids)))
+    entity_ids = db.session.scalars(ids).all()
+    _insert_catalog_changes(db.session.connection(), [(entity, entity_id, 'delete') for entity_id in entity_ids])
+
+
+def backfill_catalog_changes():
+    CatalogChange.query.delete(synchronize_session=False)
+    entries = [
+        (entity, entity_id, 'upsert')
+        for entity, model in CATALOG_MODELS.items()
+        for entity_id in db.session.scalars(db.select(model.id).order_by(model.id))
+    ]
+    _insert_catalog_changes(db.session.connection(), entries)
+
+
+def catalog_json(entity, obj):
+    if entity == 'subject':
+        return {'name': obj.name}
+    if entity == 'topic':
+        return {'name': obj.name, 'subject_id': obj.subject_id}
+    if entity == 'video':
+        return {'title': obj.title, 'youtube_id': obj.youtube_id, 'topic_id': obj.topic_id}
+    if entity == 'note':
+        url = url_for('download_file', key=obj.file_path) if obj.file_path else None
+        return {'title': obj.title, 'topic_id': obj.topic_id, 'url': url}
+    # Answer keys stay on the server.
+    return {'text': obj.text, 'topic_id': obj.topic_id, 'choices': obj.choice_list}
+
+
+def _catalog_horizon():
+    return db.session.query(db.func.max(CatalogCompaction.horizon)).scalar() or 0
+
+
+def catalog_changes(since, limit=CATALOG_PAGE_SIZE):
+    reset = {'reset': True, 'version': 0, 'changes': [], 'has_more': True}
+    if 0 < since < _catalog_horizon():
+        return reset
+
+    rows = CatalogChange.query.filter(CatalogChange.version > since).order_by(CatalogChange.version).limit(limit + 1).all()
+    # A compaction committed since the first check may have dropped deletes
+    # this page needed; its horizon row commits together with those deletes.
+    if 0 < since < _catalog_horizon():
+        return reset
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    # Only the last change per entity in this page matters.
+    latest = {}
+    for row in rows:
+        latest[(row.entity, row.entity_id)] = row
+    wanted = {}
+    for (entity, entity_id), row in latest.items():
+        if row.op == 'upsert':
+            wanted.setdefault(entity, set()).add(entity_id)
+    loaded = {}
+    for entity, ids in wanted.items():
+        model = CATALOG_MODELS[entity]
+        loaded.update({(entity, obj.id): obj for obj in model.query.filter(model.id.in_(ids))})
+
+    changes = []
+    for row in sorted(latest.values(), key=lambda r: r.version):
+        change = {'version': row.version, 'entity': row.entity, 'id': row.entity_id, 'op': row.op}
+        if row.op == 'upsert':
+            obj = loaded.get((row.entity, row.entity_id))
+            if obj is None:
+                # Deleted later in the log; that entry will follow.
+                continue
+            change['data'] = catalog_json(row.entity, obj)
+        changes.append(change)
+    version = rows[-1].version if rows else since
+    return {'reset': False, 'version': version, 'changes': changes, 'has_more': has_more}
+
+
+def compact_catalog_changes(tombstone_days):
+    # Keep only the newest entry per entity, then drop delete entries older
+    # than tombstone_days and remember how far that went.
+    newest = db.select(db.func.max(CatalogChange.version)).group_by(CatalogChange.entity, CatalogChange.entity_id)
+    removed = CatalogChange.query.filter(~CatalogChange.version.in_(newest)).delete(synchronize_session=False)
+    cutoff = datetime.utcnow() - timedelta(days=tombstone_days)
+    old_deletes = CatalogChange.query.filter(CatalogChange.op == 'delete', CatalogChange.created_at < cutoff)
+    horizon = old_deletes.with_entities(db.func.max(CatalogChange.version)).scalar()
+    if horizon:
+        removed += old_deletes.delete(synchronize_session=False)
+        db.session.add(CatalogCompaction(horizon=horizon))
+    return removed
+
+
+@app.cli.command('compact-catalog-changes')
+@click.option('--tombstone-days', default=30, type=int, help='Keep delete entries this many days.')
+def compact_catalog_changes_command(tombstone_days):
+    removed = compact_catalog_changes(tombstone_days)
+    db.session.commit()
+    print(f'Removed {removed} catalog change entries.')
+
+
 # ==================== AUTH HELPERS ====================
 
 ADMIN_USERNAME = 'admin'
@@ -442,29 +1952,1488 @@ def require_admin():
     return None
 
 
+def visible_notifications_filter(user_id):
+    cohort_ids = db.select(CohortMember.cohort_id).where(CohortMember.user_id == user_id)
+    direct_ids = db.select(NotificationRecipient.notification_id).where(NotificationRecipient.user_id == user_id)
+    return db.or_(
+        Notification.audience == 'all',
+        db.and_(Notification.audience == 'cohort', Notification.cohort_id.in_(cohort_ids)),
+        db.and_(Notification.audience == 'users', Notification.id.in_(direct_ids)),
+    )
+
+
+def _unread_count_subquery(user_id):
+    read_ids = db.select(NotificationRead.notification_id).where(NotificationRead.user_id == user_id)
+    return db.select(db.func.count(Notification.id)).where(
+        visible_notifications_filter(user_id),
+        Notification.id.not_in(read_ids)
+    ).scalar_subquery()
+
+
 def get_unread_count(user_id):
-    total = Notification.query.count()
-    read_count = NotificationRead.query.filter_by(user_id=user_id).count()
-    return max(total - read_count, 0)
+    return db.session.query(_unread_count_subquery(user_id)).scalar() or 0
+
+
+def existing_user_ids(user_ids):
+    # Foreign keys are enforced, so ids from a stale admin form must be dropped.
+    user_ids = set(user_ids)
+    if not user_ids:
+        return set()
+    return set(db.session.scalars(db.select(User.id).where(User.id.in_(user_ids))))
+
+
+def create_notification(title, body, audience='all', cohort_id=None, user_ids=()):
+    notification = Notification(title=title, body=body, audience=audience, cohort_id=cohort_id)
+    db.session.add(notification)
+    if audience == 'users':
+        db.session.flush()
+        for user_id in existing_user_ids(user_ids):
+            db.session.add(NotificationRecipient(notification_id=notification.id, user_id=user_id))
+            publish_event('notification', user_id=user_id, title=title)
+    elif audience == 'cohort':
+        publish_event('notification', cohort_id=cohort_id, title=title)
+    else:
+        publish_event('notification', title=title)
+    enqueue_notification_emails(notification)
+    return notification
 
 
 def get_unread_admin_replies_count(user_id):
-    user = User.query.get(user_id)
-    if not user:
-        return 0
-    latest_admin_msg = Message.query.filter_by(user_id=user_id, sender='admin').order_by(Message.id.desc()).first()
-    if not latest_admin_msg:
+    return get_header_badges(user_id)['admin_reply_unread']
+
+
+# Header badges are computed in one round trip, memoized on g for the rest of
+# the request and, when BADGE_CACHE_SECONDS > 0, kept per user in this worker
+# until a notification, admin reply or read invalidates them.
+badge_cache = {}
+badge_cache_lock = Lock()
+
+
+def _load_header_badges(user_id):
+    latest_admin_id = db.select(db.func.max(Message.id)).where(
+        Message.user_id == user_id,
+        Message.sender == 'admin'
+    ).scalar_subquery()
+    row = db.session.query(
+        User.last_seen_admin_message_id,
+        _unread_count_subquery(user_id),
+        latest_admin_id
+    ).filter(User.id == user_id).first()
+    if row is None:
+        return {'unread_count': 0, 'admin_reply_unread': 0}
+    last_seen, unread, latest_admin = row
+    return {
+        'unread_count': unread or 0,
+        'admin_reply_unread': 1 if latest_admin and latest_admin > (last_seen or 0) else 0
+    }
+
+
+def get_header_badges(user_id):
+    memo = g.get('header_badges')
+    if memo is not None and memo[0] == user_id:
+        return memo[1]
+
+    ttl = app.config['BADGE_CACHE_SECONDS']
+    badges = None
+    if ttl > 0:
+        with badge_cache_lock:
+            cached = badge_cache.get(user_id)
+        hit = cached is not None and cached[0] > time.monotonic()
+        record_cache_lookup('header_badges', hit)
+        if hit:
+            badges = cached[1]
+    if badges is None:
+        badges = _load_header_badges(user_id)
+        if ttl > 0:
+            with badge_cache_lock:
+                badge_cache[user_id] = (time.monotonic() + ttl, badges)
+    g.header_badges = (user_id, badges)
+    return badges
+
+
+def invalidate_header_badges(user_id=None):
+    g.pop('header_badges', None)
+    with badge_cache_lock:
+        if user_id is None:
+            badge_cache.clear()
+        else:
+            badge_cache.pop(user_id, None)
+
+
+# ==================== SESSIONS ====================
+
+# Session data lives server side; the cookie only carries an opaque random
+# id. A small per-worker LRU cache (entries trusted for SESSION_CACHE_SECONDS)
+# saves a lookup on bursts of requests, so a revoked session can still be
+# used on another worker for at most that long. Sessions are written back
+# when they change, or just touched once half their lifetime has passed, so
+# they expire after inactivity; expired rows are swept every
+# SESSION_SWEEP_INTERVAL.
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+        self.expires_at = None
+
+    def regenerate(self):
+        if not self.new:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(24)
+        self.modified = True
+
+
+# Session rows are read and written on their own connection, so saving a
+# session never commits (or rolls back) the request's unit of work.
+class DatabaseSessionBackend:
+    table = SessionRecord.__table__
+
+    def load(self, sid):
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(self.table.c.data, self.table.c.expires_at).where(self.table.c.id == sid)
+            ).first()
+        if row is None:
+            return None
+        return row.data, row.expires_at
+
+    def save(self, sid, data, user_id, expires_at):
+        values = {'data': data, 'user_id': user_id, 'expires_at': expires_at}
+        with db.engine.begin() as conn:
+            result = conn.execute(db.update(self.table).where(self.table.c.id == sid).values(**values))
+            if result.rowcount == 0:
+                conn.execute(db.insert(self.table).values(id=sid, **values))
+
+    def touch(self, sid, expires_at):
+        with db.engine.begin() as conn:
+            conn.execute(db.update(self.table).where(self.table.c.id == sid).values(expires_at=expires_at))
+
+    def delete(self, sid):
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(self.table).where(self.table.c.id == sid))
+
+    def delete_user(self, user_id, keep_sid=None):
+        query = db.delete(self.table).where(self.table.c.user_id == user_id)
+        if keep_sid:
+            query = query.where(self.table.c.id != keep_sid)
+        with db.engine.begin() as conn:
+            conn.execute(query)
+
+    def sweep(self, now):
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(self.table).where(self.table.c.expires_at < now))
+
+
+class SqliteSessionBackend:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS session_record '
+                '(id TEXT PRIMARY KEY, user_id INTEGER, data TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_session_record_user_id ON session_record (user_id)')
+            self.local.conn = conn
+        return conn
+
+    def load(self, sid):
+        row = self._conn().execute('SELECT data, expires_at FROM session_record WHERE id = ?', (sid,)).fetchone()
+        if row is None:
+            return None
+        return row[0], datetime.utcfromtimestamp(row[1])
+
+    def save(self, sid, data, user_id, expires_at):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO session_record (id, user_id, data, expires_at) VALUES (?, ?, ?, ?)',
+            (sid, user_id, data, (expires_at - datetime(1970, 1, 1)).total_seconds())
+        )
+
+    def touch(self, sid, expires_at):
+        self._conn().execute(
+            'UPDATE session_record SET expires_at = ? WHERE id = ?',
+            ((expires_at - datetime(1970, 1, 1)).total_seconds(), sid)
+        )
+
+    def delete(self, sid):
+        self._conn().execute('DELETE FROM session_record WHERE id = ?', (sid,))
+
+    def delete_user(self, user_id, keep_sid=None):
+        self._conn().execute('DELETE FROM session_record WHERE user_id = ? AND id != ?', (user_id, keep_sid or ''))
+
+    def sweep(self, now):
+        self._conn().execute('DELETE FROM session_record WHERE expires_at < ?', ((now - datetime(1970, 1, 1)).total_seconds(),))
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.cache = OrderedDict()
+        self.cache_lock = Lock()
+        self.last_sweep = 0.0
+
+    def _cache_get(self, sid):
+        with self.cache_lock:
+            entry = self.cache.get(sid)
+            if entry is None or entry[0] < time.monotonic():
+                self.cache.pop(sid, None)
+                return None
+            self.cache.move_to_end(sid)
+            return entry[1]
+
+    def _cache_put(self, sid, value):
+        with self.cache_lock:
+            self.cache[sid] = (time.monotonic() + app.config['SESSION_CACHE_SECONDS'], value)
+            self.cache.move_to_end(sid)
+            while len(self.cache) > app.config['SESSION_CACHE_SIZE']:
+                self.cache.popitem(last=False)
+
+    def _cache_drop(self, sid):
+        with self.cache_lock:
+            self.cache.pop(sid, None)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            ensure_database_initialized()
+            stored = self._cache_get(sid)
+            record_cache_lookup('session', stored is not None)
+            if stored is None:
+                stored = self.backend.load(sid)
+                if stored is not None:
+                    self._cache_put(sid, stored)
+            if stored is not None and stored[1] > datetime.utcnow():
+                loaded = ServerSession(self.serializer.loads(stored[0]), sid=sid)
+                loaded.expires_at = stored[1]
+                return loaded
+        return ServerSession(sid=secrets.token_urlsafe(24), new=True)
+
+    def save_session(self, app, session, response):
+        self._maybe_sweep()
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid:
+            self.backend.delete(session.previous_sid)
+            self._cache_drop(session.previous_sid)
+            session.previous_sid = None
+
+        if not session:
+            if not session.new:
+                self.backend.delete(session.sid)
+                self._cache_drop(session.sid)
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+
+        expires_at = datetime.utcnow() + app.permanent_session_lifetime
+        if not session.modified:
+            # Slide the expiry for active users, at most once per half lifetime.
+            if session.expires_at is None or session.expires_at - datetime.utcnow() > app.permanent_session_lifetime / 2:
+                return
+            self.backend.touch(session.sid, expires_at)
+            self._cache_drop(session.sid)
+        else:
+            data = self.serializer.dumps(dict(session))
+            self.backend.save(session.sid, data, session.get('user_id'), expires_at)
+            self._cache_put(session.sid, (data, expires_at))
+        response.set_cookie(
+            cookie_name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self.last_sweep < app.config['SESSION_SWEEP_INTERVAL']:
+            return
+        self.last_sweep = now
+        try:
+            ensure_database_initialized()
+            self.backend.sweep(datetime.utcnow())
+        except Exception:
+            app.logger.exception('Session sweep failed')
+
+    def revoke_user_sessions(self, user_id, keep_sid=None):
+        self.backend.delete_user(user_id, keep_sid=keep_sid)
+        with self.cache_lock:
+            self.cache.clear()
+
+
+if app.config['SESSION_BACKEND'] == 'database':
+    app.session_interface = ServerSessionInterface(DatabaseSessionBackend())
+elif app.config['SESSION_BACKEND'] == 'sqlite':
+    app.session_interface = ServerSessionInterface(SqliteSessionBackend(app.config['SESSION_SQLITE_PATH']))
+
+
+def regenerate_session():
+    if isinstance(session, ServerSession):
+        session.regenerate()
+
+
+def revoke_other_sessions(user_id):
+    if isinstance(app.session_interface, ServerSessionInterface):
+        app.session_interface.revoke_user_sessions(user_id, keep_sid=getattr(session, 'sid', None))
+
+
+# ==================== PASSWORD HASHING ====================
+
+# Hashing runs on a small dedicated pool (hashlib releases the GIL), and at
+# most PASSWORD_HASH_QUEUE jobs may be in flight; past that a login gets a 503
+# at once instead of holding another request thread. The method prefix of each stored
+# hash (e.g. 'scrypt:32768:8:1') records its parameters; logins rehash
+# transparently when it differs from PASSWORD_HASH_METHOD.
+class PasswordHashBusy(Exception):
+    pass
+
+
+password_hash_pool = ThreadPoolExecutor(
+    max_workers=app.config['PASSWORD_HASH_WORKERS'],
+    thread_name_prefix='password-hash'
+)
+password_hash_slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE'])
+password_method_prefixes = {}
+
+
+def _run_hash_job(fn, *args):
+    if not password_hash_slots.acquire(blocking=False):
+        metrics_inc('password_hash_rejected_total')
+        raise PasswordHashBusy()
+    try:
+        return password_hash_pool.submit(fn, *args).result()
+    finally:
+        password_hash_slots.release()
+
+
+def hash_password(password):
+    return _run_hash_job(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(password_hash, password):
+    return _run_hash_job(check_password_hash, password_hash, password)
+
+
+def password_method_prefix(method):
+    prefix = password_method_prefixes.get(method)
+    if prefix is None:
+        # werkzeug expands defaults ('scrypt' -> 'scrypt:32768:8:1'), so hash
+        # once to learn the exact prefix it will store for this method.
+        prefix = generate_password_hash('', method).split('$', 1)[0]
+        password_method_prefixes[method] = prefix
+    return prefix
+
+
+def password_needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != password_method_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+
+@app.cli.command('benchmark-password-hash')
+def benchmark_password_hash():
+    methods = [app.config['PASSWORD_HASH_METHOD'], 'scrypt:16384:8:1', 'scrypt:32768:8:1',
+               'pbkdf2:sha256:600000', 'pbkdf2:sha256:1000000']
+    seen = set()
+    for method in methods:
+        if method in seen:
+            continue
+        seen.add(method)
+        rounds = 5
+        started = time.perf_counter()
+        for _ in range(rounds):
+            generate_password_hash('benchmark-password', method)
+        elapsed = (time.perf_counter() - started) / rounds
+        print(f'{method:<28} {elapsed * 1000:8.1f} ms/hash  ~{1 / elapsed:6.1f} hashes/s per core')
+
+
+# ==================== RATE LIMITING ====================
+
+# Token buckets keyed by rule and client IP or account. Limits are written
+# as 'N/seconds': a burst of N requests, refilled at N per that many seconds.
+# By default buckets live in this worker's memory (sharded to keep lock
+# contention low); RATE_LIMIT_STORE points every worker at one shared
+# SQLite file instead.
+RATE_LIMIT_SHARDS = 16
+RATE_LIMIT_MAX_KEYS_PER_SHARD = 5000
+
+
+def parse_rate_limit(spec):
+    count, seconds = spec.split('/', 1)
+    capacity = float(count)
+    return capacity, capacity / float(seconds)
+
+
+class MemoryBucketStore:
+    def __init__(self, shards=RATE_LIMIT_SHARDS):
+        self.shards = [({}, Lock()) for _ in range(shards)]
+
+    def take(self, key, capacity, rate):
+        buckets, lock = self.shards[hash(key) % len(self.shards)]
+        now = time.monotonic()
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= RATE_LIMIT_MAX_KEYS_PER_SHARD:
+                    self._prune(buckets, now)
+                # Each bucket keeps its own refill time, since rules share a shard.
+                bucket = buckets[key] = [capacity, now, capacity / rate]
+            tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0.0
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+
+    @staticmethod
+    def _prune(buckets, now):
+        # A bucket that has refilled completely is the same as a missing one.
+        for key in [k for k, (_, updated, full_after) in buckets.items() if now - updated >= full_after]:
+            del buckets[key]
+
+
+class SqliteBucketStore:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self.local.conn = conn
+        return conn
+
+    def take(self, key, capacity, rate):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            conn.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return retry_after
+
+
+if app.config['RATE_LIMIT_STORE']:
+    rate_limit_store = SqliteBucketStore(app.config['RATE_LIMIT_STORE'])
+else:
+    rate_limit_store = MemoryBucketStore()
+rate_limit_rules = {name: parse_rate_limit(spec) for name, spec in app.config['RATE_LIMITS'].items()}
+
+
+def client_ip():
+    # The leftmost X-Forwarded-For entry is whatever the client sent; only the
+    # last one, appended by the trusted proxy itself, can be relied on.
+    if app.config['RATE_LIMIT_TRUST_PROXY'] and request.access_route:
+        return request.access_route[-1]
+    return request.remote_addr or 'unknown'
+
+
+def rate_limit(rule, key):
+    if not app.config['RATE_LIMIT_ENABLED'] or not key:
         return 0
-    return 1 if latest_admin_msg.id > (user.last_seen_admin_message_id or 0) else 0
+    capacity, rate = rate_limit_rules[rule]
+    retry_after = rate_limit_store.take(f'{rule}:{key}', capacity, rate)
+    if retry_after > 0:
+        metrics_inc('rate_limited_total', rule=rule)
+    return retry_after
+
+
+def too_many_requests(template, retry_after):
+    seconds = max(int(retry_after + 0.999), 1)
+    response = app.make_response((
+        render_template(template, error=f'Too many attempts. Try again in {seconds} seconds.'),
+        429
+    ))
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+# ==================== METRICS ====================
+
+# Each worker keeps its own counters in memory and periodically dumps them to
+# METRICS_DIR/<pid>-<start>.json; /metrics sums every worker file so scrapes
+# are correct no matter which gunicorn worker answers them. Files of exited
+# workers are folded into retired.json, so totals never go backwards.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_HELP = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint, method and status.'),
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency by endpoint.'),
+    'cache_requests_total': ('counter', 'Cache lookups by cache name and result.'),
+    'upload_bytes_total': ('counter', 'Bytes written by file uploads.'),
+    'rate_limited_total': ('counter', 'Requests rejected by the rate limiter, by rule.'),
+    'password_hash_rejected_total': ('counter', 'Password hash jobs rejected because the hash pool was saturated.'),
+    'mail_sent_total': ('counter', 'Notification emails accepted by the SMTP server.'),
+    'mail_failed_total': ('counter', 'Notification email send attempts that failed.'),
+    'db_pool_connections': ('gauge', 'Database pool connections by state and worker.'),
+}
+
+metrics_lock = Lock()
+metrics_counters = {}
+metrics_histograms = {}
+metrics_last_flush = 0.0
+metrics_worker = {'pid': None, 'started': None}
+RETIRED_METRICS_FILE = 'retired.json'
+
+
+def _metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def metrics_inc(name, value=1, **labels):
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        metrics_counters[key] = metrics_counters.get(key, 0) + value
+
+
+def metrics_observe(name, value, **labels):
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        entry = metrics_histograms.get(key)
+        if entry is None:
+            entry = metrics_histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+
+def record_cache_lookup(cache_name, hit):
+    metrics_inc('cache_requests_total', cache=cache_name, result='hit' if hit else 'miss')
+
+
+def db_pool_stats():
+    pool = db.engine.pool
+    stats = {}
+    for state, attr in (('checked_out', 'checkedout'), ('checked_in', 'checkedin'),
+                        ('overflow', 'overflow'), ('size', 'size')):
+        fn = getattr(pool, attr, None)
+        if fn is None:
+            continue
+        try:
+            stats[state] = fn()
+        except Exception:
+            continue
+    return stats
+
+
+def _metrics_snapshot():
+    with metrics_lock:
+        counters = [[name, list(labels), value] for (name, labels), value in metrics_counters.items()]
+        histograms = [
+            [name, list(labels), list(entry[0]), entry[1], entry[2]]
+            for (name, labels), entry in metrics_histograms.items()
+        ]
+    return {
+        'pid': os.getpid(),
+        'started': metrics_worker['started'],
+        'counters': counters,
+        'histograms': histograms,
+        'pool': db_pool_stats(),
+    }
+
+
+def _metrics_worker_file():
+    # The start time keeps a recycled pid from overwriting a dead worker's file.
+    pid = os.getpid()
+    if metrics_worker['pid'] != pid:
+        metrics_worker['pid'] = pid
+        metrics_worker['started'] = int(time.time() * 1000)
+    return f"{pid}-{metrics_worker['started']}.json"
+
+
+def metrics_flush(force=False):
+    global metrics_last_flush
+    now = time.monotonic()
+    if not force and now - metrics_last_flush < app.config['METRICS_FLUSH_INTERVAL']:
+        return
+    metrics_last_flush = now
+    path = os.path.join(app.config['METRICS_DIR'], _metrics_worker_file())
+    snapshot = _metrics_snapshot()
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as fh:
+            json.dump(snapshot, fh)
+        os.replace(tmp_path, path)
+    except OSError:
+        app.logger.exception('Could not write metrics snapshot')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{escaped}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _read_metric_snapshots():
+    snapshots = {}
+    for filename in os.listdir(app.config['METRICS_DIR']):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(app.config['METRICS_DIR'], filename)) as fh:
+                snapshots[filename] = json.load(fh)
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge_metric_snapshot(counters, histograms, snapshot):
+    for name, labels, value in snapshot.get('counters', []):
+        key = (name, tuple(tuple(pair) for pair in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, buckets, total, count in snapshot.get('histograms', []):
+        key = (name, tuple(tuple(pair) for pair in labels))
+        entry = histograms.setdefault(key, [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+        for i, bucket_count in enumerate(buckets[:len(LATENCY_BUCKETS)]):
+            entry[0][i] += bucket_count
+        entry[1] += total
+        entry[2] += count
+
+
+def _dead_metric_files(snapshots):
+    newest = {}
+    for snapshot in snapshots.values():
+        pid = snapshot.get('pid')
+        if pid is not None:
+            newest[pid] = max(newest.get(pid, 0), snapshot.get('started') or 0)
+    dead = []
+    for filename, snapshot in snapshots.items():
+        pid = snapshot.get('pid')
+        if pid is None:
+            continue
+        # Only the newest file for a pid can belong to a running worker.
+        if (snapshot.get('started') or 0) < newest[pid] or not _pid_alive(pid):
+            dead.append(filename)
+    return dead
+
+
+def _retire_metric_files(dead):
+    metrics_dir = app.config['METRICS_DIR']
+    lock_path = os.path.join(metrics_dir, 'retired.lock')
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        # Another worker is retiring files; a lock left by a crash is cleared after a minute.
+        try:
+            if time.time() - os.path.getmtime(lock_path) > 60:
+                os.remove(lock_path)
+        except OSError:
+            pass
+        return
+    except OSError:
+        return
+    try:
+        retired_path = os.path.join(metrics_dir, RETIRED_METRICS_FILE)
+        try:
+            with open(retired_path) as fh:
+                retired = json.load(fh)
+        except (OSError, ValueError):
+            retired = {}
+        # Files already folded in last time but not yet removed.
+        for filename in retired.get('merged', []):
+            try:
+                os.remove(os.path.join(metrics_dir, filename))
+            except OSError:
+                pass
+        counters = {}
+        histograms = {}
+        _merge_metric_snapshot(counters, histograms, retired)
+        merged = []
+        for filename in dead:
+            if filename in retired.get('merged', []):
+                continue
+            try:
+                with open(os.path.join(metrics_dir, filename)) as fh:
+                    _merge_metric_snapshot(counters, histograms, json.load(fh))
+            except (OSError, ValueError):
+                continue
+            merged.append(filename)
+        tmp_path = retired_path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump({
+                'pid': None,
+                'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+                'histograms': [
+                    [name, list(labels), list(entry[0]), entry[1], entry[2]]
+                    for (name, labels), entry in histograms.items()
+                ],
+                'merged': merged,
+            }, fh)
+        os.replace(tmp_path, retired_path)
+        for filename in merged:
+            try:
+                os.remove(os.path.join(metrics_dir, filename))
+            except OSError:
+                pass
+    except OSError:
+        app.logger.exception('Could not retire metrics snapshots')
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+def render_metrics():
+    metrics_flush(force=True)
+    snapshots = _read_metric_snapshots()
+    dead = _dead_metric_files(snapshots)
+    if dead:
+        _retire_metric_files(dead)
+        snapshots = _read_metric_snapshots()
+    already_retired = set(snapshots.get(RETIRED_METRICS_FILE, {}).get('merged', []))
+    counters = {}
+    histograms = {}
+    pools = {}
+    for filename, snapshot in snapshots.items():
+        if filename in already_retired:
+            continue
+        _merge_metric_snapshot(counters, histograms, snapshot)
+        # Pool gauges only make sense for workers that are still running.
+        pid = snapshot.get('pid')
+        if pid is not None and filename not in dead and _pid_alive(pid):
+            pools[pid] = snapshot.get('pool', {})
+
+    lines = []
+    emitted = set()
+
+    def header(name):
+        if name in emitted:
+            return
+        emitted.add(name)
+        kind, text = METRIC_HELP.get(name, ('untyped', name))
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name)
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        header(name)
+        for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {bucket_count}')
+        lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels)} {count}')
+
+    header('db_pool_connections')
+    for pid, stats in sorted(pools.items()):
+        for state, value in sorted(stats.items()):
+            lines.append(f'db_pool_connections{_format_labels((("pid", pid), ("state", state)))} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+# ==================== PROFILING ====================
+
+# Admins switch sampling on with POST /admin/profiling (stored in a settings
+# file so every worker picks it up) or for a single request with the
+# X-Profile header. When the rate is 0 the only per-request cost is one
+# random() call and a cached settings lookup.
+PROFILE_SETTINGS_RELOAD = 2.0
+
+profile_settings = {'sample_rate': app.config['PROFILE_SAMPLE_RATE'], 'loaded_at': 0.0}
+profile_listeners_installed = False
+
+
+def _profile_settings_path():
+    return os.path.join(app.config['PROFILE_DIR'], 'settings.json')
+
+
+def get_profile_sample_rate():
+    now = time.monotonic()
+    if now - profile_settings['loaded_at'] >= PROFILE_SETTINGS_RELOAD:
+        profile_settings['loaded_at'] = now
+        try:
+            with open(_profile_settings_path()) as fh:
+                profile_settings['sample_rate'] = float(json.load(fh).get('sample_rate', 0))
+        except (OSError, ValueError):
+            profile_settings['sample_rate'] = app.config['PROFILE_SAMPLE_RATE']
+    return profile_settings['sample_rate']
+
+
+def set_profile_sample_rate(rate):
+    rate = min(max(rate, 0.0), 1.0)
+    tmp_path = _profile_settings_path() + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump({'sample_rate': rate}, fh)
+    os.replace(tmp_path, _profile_settings_path())
+    profile_settings['sample_rate'] = rate
+    profile_settings['loaded_at'] = time.monotonic()
+    return rate
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            parts = []
+            while frame is not None:
+                code = frame.f_code
+                parts.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            key = ';'.join(reversed(parts))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+
+def _install_profile_listeners():
+    global profile_listeners_installed
+    if profile_listeners_installed:
+        return
+    profile_listeners_installed = True
+
+    def _query_started(conn, cursor, statement, parameters, context, executemany):
+        if g.get('profile_queries') is not None:
+            context._profile_started = time.perf_counter()
+
+    def _query_finished(conn, cursor, statement, parameters, context, executemany):
+        stats = g.get('profile_queries')
+        started = getattr(context, '_profile_started', None)
+        if stats is not None and started is not None:
+            stats['count'] += 1
+            stats['seconds'] += time.perf_counter() - started
+
+    for engine in db.engines.values():
+        event.listen(engine, 'before_cursor_execute', _query_started)
+        event.listen(engine, 'after_cursor_execute', _query_finished)
+
+
+def should_profile_request():
+    if request.headers.get('X-Profile') and is_admin_logged_in():
+        return True
+    rate = get_profile_sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+def start_request_profile():
+    _install_profile_listeners()
+    g.profile_queries = {'count': 0, 'seconds': 0.0}
+    g.profile_sampler = StackSampler(threading.get_ident(), app.config['PROFILE_INTERVAL'])
+    g.profile_sampler.start()
+
+
+def finish_request_profile(duration, status):
+    sampler = g.pop('profile_sampler', None)
+    queries = g.pop('profile_queries', None)
+    if sampler is None:
+        return
+    sampler.stop()
+    # Names sort by time; the random part keeps concurrent requests apart.
+    now = time.time()
+    stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1000) % 1000:03d}"
+    name = f"{stamp}-{os.getpid()}-{secrets.token_hex(4)}-{request.endpoint or 'unmatched'}"
+    base = os.path.join(app.config['PROFILE_DIR'], name)
+    try:
+        with open(base + '.folded', 'w') as fh:
+            for stack, count in sorted(sampler.stacks.items()):
+                fh.write(f'{stack} {count}\n')
+        with open(base + '.json', 'w') as fh:
+            json.dump({
+                'endpoint': request.endpoint,
+                'path': request.path,
+                'method': request.method,
+                'status': status,
+                'duration_seconds': duration,
+                'samples': sampler.samples,
+                'interval_seconds': sampler.interval,
+                'query_count': queries['count'],
+                'query_seconds': queries['seconds'],
+            }, fh)
+    except OSError:
+        app.logger.exception('Could not write request profile')
+    prune_profiles()
+
+
+def prune_profiles():
+    names = sorted(f for f in os.listdir(app.config['PROFILE_DIR']) if f.endswith('.json') and f != 'settings.json')
+    for filename in names[:max(len(names) - app.config['PROFILE_MAX_FILES'], 0)]:
+        base = os.path.join(app.config['PROFILE_DIR'], filename[:-len('.json')])
+        for path in (base + '.json', base + '.folded'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def list_profiles(limit=50):
+    names = sorted(
+        (f for f in os.listdir(app.config['PROFILE_DIR']) if f.endswith('.json') and f != 'settings.json'),
+        reverse=True
+    )
+    profiles = []
+    for filename in names[:limit]:
+        try:
+            with open(os.path.join(app.config['PROFILE_DIR'], filename)) as fh:
+                info = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        info['folded_file'] = filename[:-len('.json')] + '.folded'
+        profiles.append(info)
+    return profiles
+
+
+# ==================== LIVE EVENTS ====================
+
+# Events are written to the live_event table in the same transaction as the
+# change they announce. One poller thread per worker tails that table and
+# hands new rows to the local SSE subscribers, so broadcasts reach tabs open
+# on any worker. Subscriber queues are bounded and streams are recycled after
+# EVENTS_STREAM_SECONDS; EventSource resumes from Last-Event-ID.
+EVENT_QUEUE_SIZE = 50
+EVENT_HEARTBEAT_SECONDS = 15
+
+event_subscribers = {}
+event_subscribers_lock = Lock()
+event_poller_started = False
+event_poller_lock = Lock()
+
+
+def publish_event(kind, user_id=None, cohort_id=None, **data):
+    db.session.add(LiveEvent(user_id=user_id, cohort_id=cohort_id, kind=kind, payload=json.dumps(data)))
+
+
+def _dispatch_event(row):
+    message = (row.id, row.kind, row.payload)
+    member_ids = None
+    if row.cohort_id is not None:
+        member_ids = {m.user_id for m in CohortMember.query.filter_by(cohort_id=row.cohort_id).all()}
+    with event_subscribers_lock:
+        if member_ids is not None:
+            targets = [q for uid in member_ids for q in event_subscribers.get(uid, ())]
+        elif row.user_id is None:
+            targets = [q for queues in event_subscribers.values() for q in queues]
+        else:
+            targets = list(event_subscribers.get(row.user_id, ()))
+    for q in targets:
+        try:
+            q.put_nowait(message)
+        except queue.Full:
+            pass
+
+
+def _poll_events(last_id):
+    last_cleanup = 0.0
+    while True:
+        time.sleep(app.config['EVENTS_POLL_INTERVAL'])
+        with event_subscribers_lock:
+            idle = not event_subscribers
+        try:
+            with app.app_context():
+                if not idle:
+                    rows = LiveEvent.query.filter(LiveEvent.id > last_id).order_by(LiveEvent.id).limit(500).all()
+                    for row in rows:
+                        _dispatch_event(row)
+                        last_id = row.id
+                else:
+                    last_id = db.session.query(db.func.max(LiveEvent.id)).scalar() or last_id
+                if time.monotonic() - last_cleanup > 300:
+                    last_cleanup = time.monotonic()
+                    cutoff = datetime.utcnow() - timedelta(minutes=app.config['EVENTS_RETENTION_MINUTES'])
+                    LiveEvent.query.filter(LiveEvent.created_at < cutoff).delete(synchronize_session=False)
+                    db.session.commit()
+        except Exception:
+            app.logger.exception('Live event poll failed')
+
+
+def ensure_event_poller():
+    global event_poller_started
+    if event_poller_started:
+        return
+    with event_poller_lock:
+        if event_poller_started:
+            return
+        last_id = db.session.query(db.func.max(LiveEvent.id)).scalar() or 0
+        threading.Thread(target=_poll_events, args=(last_id,), name='live-event-poller', daemon=True).start()
+        event_poller_started = True
+
+
+def subscribe_events(user_id):
+    with event_subscribers_lock:
+        total = sum(len(queues) for queues in event_subscribers.values())
+        if total >= app.config['EVENTS_MAX_CONNECTIONS']:
+            return None
+        if len(event_subscribers.get(user_id, ())) >= app.config['EVENTS_MAX_PER_USER']:
+            return None
+        q = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+        event_subscribers.setdefault(user_id, set()).add(q)
+    return q
+
+
+def unsubscribe_events(user_id, q):
+    with event_subscribers_lock:
+        queues = event_subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(q)
+        if not queues:
+            del event_subscribers[user_id]
+
+
+def _format_sse(event_id, kind, payload):
+    return f'id: {event_id}\nevent: {kind}\ndata: {payload}\n\n'
+
+
+def stream_events(user_id, q, backlog):
+    deadline = time.monotonic() + app.config['EVENTS_STREAM_SECONDS']
+    try:
+        yield 'retry: 2000\n\n'
+        last_sent = 0
+        for event_id, kind, payload in backlog:
+            yield _format_sse(event_id, kind, payload)
+            last_sent = event_id
+        while time.monotonic() < deadline:
+            try:
+                event_id, kind, payload = q.get(timeout=EVENT_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ': ping\n\n'
+                continue
+            if event_id > last_sent:
+                yield _format_sse(event_id, kind, payload)
+                last_sent = event_id
+    finally:
+        unsubscribe_events(user_id, q)
+
+
+# ==================== EMAIL ====================
+
+# Notifications fan out into outbound_email with one INSERT ... SELECT, in the
+# same transaction as the notification, so the admin request never touches
+# SMTP. A dispatcher (a thread per web worker, or `flask send-mail` as its own
+# process) claims due rows in batches, sends them over one reused SMTP
+# connection at MAIL_SEND_RATE messages per second, and retries failures with
+# exponential backoff.
+MAIL_STALE_CLAIM_MINUTES = 10
+
+mail_dispatcher_started = False
+mail_dispatcher_lock = Lock()
+
+
+def mail_enabled():
+    return bool(app.config['MAIL_SERVER'])
+
+
+def enqueue_notification_emails(notification):
+    if not mail_enabled():
+        return
+    db.session.flush()
+    if notification.audience == 'users':
+        recipients = db.select(NotificationRecipient.user_id).where(
+            NotificationRecipient.notification_id == notification.id
+        )
+    elif notification.audience == 'cohort':
+        recipients = db.select(CohortMember.user_id).where(CohortMember.cohort_id == notification.cohort_id)
+    else:
+        recipients = db.select(User.id)
+    rows = db.select(db.literal(notification.id), recipients.subquery().c[0])
+    db.session.execute(db.insert(OutboundEmail).from_select(['notification_id', 'user_id'], rows))
+
+
+def _claim_outbound_batch(token):
+    now = datetime.utcnow()
+    OutboundEmail.query.filter(
+        OutboundEmail.status == 'sending',
+        OutboundEmail.claimed_at < now - timedelta(minutes=MAIL_STALE_CLAIM_MINUTES)
+    ).update({OutboundEmail.status: 'pending', OutboundEmail.claim: None}, synchronize_session=False)
+    due = db.select(OutboundEmail.id).where(
+        OutboundEmail.status == 'pending',
+        OutboundEmail.next_attempt_at <= now
+    ).order_by(OutboundEmail.id).limit(app.config['MAIL_BATCH_SIZE'])
+    # Re-checking status keeps two dispatchers from claiming the same row.
+    OutboundEmail.query.filter(OutboundEmail.id.in_(due), OutboundEmail.status == 'pending').update(
+        {OutboundEmail.status: 'sending', OutboundEmail.claim: token, OutboundEmail.claimed_at: now},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return db.session.query(OutboundEmail, Notification, User).join(
+        Notification, Notification.id == OutboundEmail.notification_id
+    ).join(
+        User, User.id == OutboundEmail.user_id
+    ).filter(OutboundEmail.claim == token, OutboundEmail.status == 'sending').order_by(OutboundEmail.id).all()
+
+
+def _open_smtp():
+    smtp = smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'], timeout=30)
+    if app.config['MAIL_USE_TLS']:
+        smtp.starttls()
+    if app.config['MAIL_USERNAME']:
+        smtp.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+    return smtp
+
+
+def _build_email(notification, user):
+    message = EmailMessage()
+    message['From'] = app.config['MAIL_SENDER']
+    message['To'] = user.email
+    message['Subject'] = notification.title
+    message.set_content(f'Hi {user.name},\n\n{notification.body}\n\n- EEE LearnHub')
+    return message
+
+
+def _mark_failed(row, error, permanent=False):
+    row.attempts += 1
+    row.claim = None
+    row.last_error = str(error)[:300]
+    if permanent or row.attempts >= app.config['MAIL_MAX_ATTEMPTS']:
+        row.status = 'failed'
+        return
+    delay = app.config['MAIL_RETRY_SECONDS'] * 2 ** (row.attempts - 1)
+    row.status = 'pending'
+    row.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def dispatch_mail_batch(smtp=None):
+    # Sends one claimed batch and returns (number claimed, open connection).
+    token = secrets.token_hex(16)
+    batch = _claim_outbound_batch(token)
+    if not batch:
+        return 0, smtp
+    interval = 1.0 / app.config['MAIL_SEND_RATE'] if app.config['MAIL_SEND_RATE'] > 0 else 0.0
+    next_send = time.monotonic()
+    for index, (row, notification, user) in enumerate(batch):
+        wait = next_send - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        next_send = max(next_send, time.monotonic()) + interval
+        try:
+            if smtp is None:
+                smtp = _open_smtp()
+            try:
+                smtp.send_message(_build_email(notification, user))
+            except smtplib.SMTPServerDisconnected:
+                smtp = _open_smtp()
+                smtp.send_message(_build_email(notification, user))
+        except smtplib.SMTPRecipientsRefused as exc:
+            _mark_failed(row, exc, permanent=True)
+        except (smtplib.SMTPException, OSError) as exc:
+            # The server is unreachable or unhappy; back off the rest of the batch too.
+            for pending_row, _, _ in batch[index:]:
+                _mark_failed(pending_row, exc)
+            db.session.commit()
+            metrics_inc('mail_failed_total', value=len(batch) - index)
+            if smtp is not None:
+                try:
+                    smtp.close()
+                except Exception:
+                    pass
+            return len(batch), None
+        else:
+            row.status = 'sent'
+            row.sent_at = datetime.utcnow()
+            row.claim = None
+            metrics_inc('mail_sent_total')
+    db.session.commit()
+    return len(batch), smtp
+
+
+def run_mail_dispatcher(stop_when_idle=False):
+    smtp = None
+    while True:
+        try:
+            with app.app_context():
+                claimed, smtp = dispatch_mail_batch(smtp)
+        except Exception:
+            app.logger.exception('Mail dispatch failed')
+            claimed, smtp = 0, None
+        if claimed:
+            continue
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                pass
+            smtp = None
+        if stop_when_idle:
+            return
+        time.sleep(app.config['MAIL_POLL_INTERVAL'])
+
+
+def ensure_mail_dispatcher():
+    global mail_dispatcher_started
+    if mail_dispatcher_started or not mail_enabled() or not app.config['MAIL_DISPATCH_IN_WEB']:
+        return
+    with mail_dispatcher_lock:
+        if mail_dispatcher_started:
+            return
+        threading.Thread(target=run_mail_dispatcher, name='mail-dispatcher', daemon=True).start()
+        mail_dispatcher_started = True
+
+
+@app.cli.command('send-mail')
+@click.option('--once', is_flag=True, help='Drain the queue and exit instead of polling.')
+def send_mail_command(once):
+    if not mail_enabled():
+        print('MAIL_SERVER is not set.')
+        return
+    run_mail_dispatcher(stop_when_idle=once)
+    print('Mail queue drained.')
+
+
+class _MailSinkHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP to accept mail from smtplib; each message is written to
+    # the sink directory as an .eml file.
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.reply('220 learnhub-mail-sink ready')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 learnhub-mail-sink')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:].strip(' <>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                self.server.store(recipients, b''.join(lines))
+                self.reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class MailSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, directory):
+        super().__init__(address, _MailSinkHandler)
+        self.directory = directory
+        self.counter = 0
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def store(self, recipients, body):
+        with self.lock:
+            self.counter += 1
+            name = f'{int(time.time())}-{self.counter:06d}.eml'
+        with open(os.path.join(self.directory, name), 'wb') as fh:
+            fh.write(body)
+        print(f'{name}: {", ".join(recipients)}')
+
+
+@app.cli.command('mail-sink')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=1025, type=int)
+@click.option('--directory', default=os.path.join(db_dir, 'mail'))
+def mail_sink_command(host, port, directory):
+    print(f'Accepting mail on {host}:{port}; run with MAIL_SERVER={host} MAIL_PORT={port} MAIL_USE_TLS=0.')
+    MailSink((host, port), directory).serve_forever()
+
+
+# ==================== READ REPLICAS ====================
+
+# GET handlers wrapped in @read_replica read from a random replica. A user
+# who just wrote something (any successful non-GET request) is pinned to the
+# primary for READ_YOUR_WRITES_SECONDS so they never see their own change
+# disappear because of replication lag.
+
+def read_replica(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        use_replica = (
+            REPLICA_BIND_KEYS
+            and request.method == 'GET'
+            and session.get('primary_until', 0) <= time.time()
+        )
+        if not use_replica:
+            return view(*args, **kwargs)
+        g.db_replica = random.choice(REPLICA_BIND_KEYS)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            # Session saving and teardown run after the view; keep them on the primary.
+            g.pop('db_replica', None)
+    return wrapper
+
+
+@app.after_request
+def pin_writers_to_primary(response):
+    if (REPLICA_BIND_KEYS and request.method not in ('GET', 'HEAD', 'OPTIONS')
+            and response.status_code < 400 and (is_user_logged_in() or is_admin_logged_in())):
+        session['primary_until'] = time.time() + app.config['READ_YOUR_WRITES_SECONDS']
+    return response
+
+
+@app.cli.command('copy-to-replicas')
+def copy_to_replicas_command():
+    # Local testing aid: snapshot a SQLite primary into SQLite replica files.
+    primary = db.engine
+    if primary.dialect.name != 'sqlite':
+        print('copy-to-replicas only works with SQLite; use streaming replication for Postgres.')
+        return
+    for key in REPLICA_BIND_KEYS:
+        replica = db.engines[key]
+        if replica.dialect.name != 'sqlite':
+            print(f'Skipping {key}: not SQLite.')
+            continue
+        source = primary.raw_connection()
+        target = replica.raw_connection()
+        try:
+            source.driver_connection.backup(target.driver_connection)
+        finally:
+            target.close()
+            source.close()
+        print(f'Copied primary into {key} ({replica.url.database}).')
 
 
 # ==================== ROUTES ====================
 
 @app.before_request
 def bootstrap_database():
-    if request.endpoint == 'health':
+    if request.endpoint in ('health', 'metrics'):
         return None
     ensure_database_initialized()
+    ensure_mail_dispatcher()
+
+
+@app.before_request
+def hide_stored_files():
+    # Files stored under static/ by older versions are only served via /files/.
+    if request.endpoint == 'static' and (request.view_args or {}).get('filename', '').startswith(('uploads/', 'certificates/')):
+        abort(404)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if request.endpoint not in ('health', 'metrics', 'static') and should_profile_request():
+        start_request_profile()
+
+
+@app.after_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(exc):
+    # Teardown runs even when a view raised, so failed requests count as 500s.
+    started = g.pop('request_started', None)
+    duration = time.perf_counter() - started if started is not None else 0.0
+    status = 500 if exc is not None else g.get('response_status', 500)
+    try:
+        if started is not None and request.endpoint != 'metrics':
+            endpoint = request.endpoint or 'unmatched'
+            metrics_inc('http_requests_total', endpoint=endpoint, method=request.method, status=status)
+            metrics_observe('http_request_duration_seconds', duration, endpoint=endpoint)
+            metrics_flush()
+    finally:
+        # Always stop the sampler thread, or it keeps sampling a reused thread.
+        if 'profile_sampler' in g:
+            finish_request_profile(duration, status)
+
+
+# Student pages the service worker may keep offline. They are per user, so
+# they are private and revalidated (cheaply, via ETag) on every use.
+CACHEABLE_PAGES = {'dashboard', 'subjects', 'topics', 'learning', 'interview'}
+
+
+@app.after_request
+def set_cache_headers(response):
+    endpoint = request.endpoint or ''
+    if endpoint == 'download_file' and response.status_code == 200:
+        # Storage keys are never reused, so a downloaded file never changes.
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+    if 'Cache-Control' in response.headers:
+        # Static files (SEND_FILE_MAX_AGE_DEFAULT) and the SSE stream set their own.
+        return response
+    if endpoint in CACHEABLE_PAGES and request.method == 'GET' and response.status_code == 200:
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        response.add_etag()
+        response.make_conditional(request)
+    elif endpoint.startswith('admin') or is_user_logged_in() or is_admin_logged_in():
+        response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+
+@app.route('/sw.js')
+def service_worker():
+    response = send_from_directory(os.path.join(app.static_folder, 'js'), 'sw.js', mimetype='text/javascript')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 @app.route('/health')
@@ -472,6 +3441,15 @@ def health():
     return {'status': 'ok'}, 200
 
 
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    authorized = is_admin_logged_in() or (token and request.headers.get('Authorization') == f'Bearer {token}')
+    if not authorized:
+        return ('', 403)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/')
 def index():
     return render_template('login.html')
@@ -482,11 +3460,21 @@ def login():
     if request.method == 'POST':
         email = request.form.get('email', '').strip().lower()
         password = request.form.get('password', '').strip()
+        retry_after = rate_limit('login_ip', client_ip()) or rate_limit('login_account', email)
+        if retry_after:
+            return too_many_requests('login.html', retry_after)
         user = User.query.filter_by(email=email).first()
-        if user and check_password_hash(user.password_hash, password):
-            session['user_id'] = user.id
-            session['user_name'] = user.name
-            return redirect(url_for('dashboard'))
+        try:
+            if user and verify_password(user.password_hash, password):
+                if password_needs_rehash(user.password_hash):
+                    user.password_hash = hash_password(password)
+                    db.session.commit()
+                regenerate_session()
+                session['user_id'] = user.id
+                session['user_name'] = user.name
+                return redirect(url_for('dashboard'))
+        except PasswordHashBusy:
+            return render_template('login.html', error='Server is busy, please try again in a moment'), 503
         return render_template('login.html', error='Invalid email or password')
     return render_template('login.html')
 
@@ -497,6 +3485,9 @@ def register():
         name = request.form.get('name', '').strip()
         email = request.form.get('email', '').strip().lower()
         password = request.form.get('password', '').strip()
+        retry_after = rate_limit('register_ip', client_ip())
+        if retry_after:
+            return too_many_requests('register.html', retry_after)
         if not name or not email or not password:
             return render_template('register.html', error='All fields are required')
 
@@ -504,12 +3495,19 @@ def register():
         if existing:
             return render_template('register.html', error='Email already registered')
 
+        try:
+            password_hash = hash_password(password)
+        except PasswordHashBusy:
+            return render_template('register.html', error='Server is busy, please try again in a moment'), 503
+
         user = User(
             name=name,
             email=email,
-            password_hash=generate_password_hash(password)
+            password_hash=password_hash
         )
         db.session.add(user)
+        bump_rollup('students', 0, 1)
+        bump_daily('registrations', 1)
         db.session.commit()
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -519,7 +3517,11 @@ def register():
 def logout():
     session.pop('user_id', None)
     session.pop('user_name', None)
-    return redirect(url_for('login'))
+    response = redirect(url_for('login'))
+    # "cache" only covers the HTTP cache; the service worker's CacheStorage
+    # (pages and PDFs cached for this student) is part of "storage".
+    response.headers['Clear-Site-Data'] = '"cache", "storage"'
+    return response
 
 
 @app.route('/profile', methods=['GET', 'POST'])
@@ -534,15 +3536,18 @@ def profile():
         name = request.form.get('name', '').strip()
         new_password = request.form.get('password', '').strip()
 
-        if name:
-            user.name = name
-            session['user_name'] = name
-
-        if new_password:
-            user.password_hash = generate_password_hash(new_password)
-
-        db.session.commit()
-        message = 'Profile updated successfully'
+        try:
+            if new_password:
+                user.password_hash = hash_password(new_password)
+            if name:
+                user.name = name
+                session['user_name'] = name
+            db.session.commit()
+            if new_password:
+                revoke_other_sessions(user.id)
+            message = 'Profile updated successfully'
+        except PasswordHashBusy:
+            message = 'Server is busy, please try again in a moment'
 
     return render_template('profile.html', user=user, message=message)
 
@@ -553,7 +3558,7 @@ def notifications():
         return redirect(url_for('login'))
 
     user_id = session['user_id']
-    items = Notification.query.order_by(Notification.id.desc()).all()
+    items = Notification.query.filter(visible_notifications_filter(user_id)).order_by(Notification.id.desc()).all()
 
     existing_reads = NotificationRead.query.filter_by(user_id=user_id).all()
     read_ids = {r.notification_id for r in existing_reads}
@@ -561,161 +3566,274 @@ def notifications():
         if n.id not in read_ids:
             db.session.add(NotificationRead(user_id=user_id, notification_id=n.id))
     db.session.commit()
+    invalidate_header_badges(user_id)
 
     return render_template('notifications.html', notifications=items)
 
 
+CONTACT_PAGE_SIZE = 30
+
+
+def message_json(msg):
+    return {'id': msg.id, 'sender': msg.sender, 'text': msg.text}
+
+
+def contact_messages_page(user_id, before_id=None, since_id=None):
+    # Keyset pages over (user_id, id): newest-first before a cursor, or
+    # oldest-first after since_id for polling. Returns (messages, has_more).
+    query = Message.query.filter(Message.user_id == user_id)
+    if since_id is not None:
+        rows = query.filter(Message.id > since_id).order_by(Message.id).limit(CONTACT_PAGE_SIZE + 1).all()
+        return rows[:CONTACT_PAGE_SIZE], len(rows) > CONTACT_PAGE_SIZE
+    if before_id is not None:
+        query = query.filter(Message.id < before_id)
+    rows = query.order_by(Message.id.desc()).limit(CONTACT_PAGE_SIZE + 1).all()
+    return list(reversed(rows[:CONTACT_PAGE_SIZE])), len(rows) > CONTACT_PAGE_SIZE
+
+
+def mark_admin_replies_seen(user_id, messages):
+    latest_admin_id = max((m.id for m in messages if m.sender == 'admin'), default=0)
+    if not latest_admin_id:
+        return
+    updated = User.query.filter(
+        User.id == user_id,
+        User.last_seen_admin_message_id < latest_admin_id
+    ).update({User.last_seen_admin_message_id: latest_admin_id}, synchronize_session=False)
+    if updated:
+        db.session.commit()
+        invalidate_header_badges(user_id)
+
+
+@app.route('/api/catalog/changes')
+def api_catalog_changes():
+    if not (is_user_logged_in() or is_admin_logged_in()):
+        return ({'error': 'Not logged in'}, 401)
+    since = max(request.args.get('since', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', CATALOG_PAGE_SIZE, type=int), 1), CATALOG_PAGE_SIZE)
+    return catalog_changes(since, limit)
+
+
 @app.route('/contact', methods=['GET', 'POST'])
 def contact():
     if not is_user_logged_in():
         return redirect(url_for('login'))
 
-    user = User.query.get_or_404(session['user_id'])
-    message = None
-    user_messages = Message.query.filter_by(user_id=user.id).order_by(Message.id.desc()).all()
-    latest_admin_msg = Message.query.filter_by(user_id=user.id, sender='admin').order_by(Message.id.desc()).first()
-
+    user_id = session['user_id']
     if request.method == 'POST':
-        text = request.form.get('message', '').strip()
-        if text:
-            db.session.add(Message(
-                user_id=user.id,
-                user_name=user.name,
-                user_email=user.email,
-                text=text,
-                sender='student'
-            ))
-            db.session.commit()
-            message = 'Message sent to admin'
-
-    if latest_admin_msg and latest_admin_msg.id > (user.last_seen_admin_message_id or 0):
-        user.last_seen_admin_message_id = latest_admin_msg.id
+        text = request.form.get('message', '').strip()[:500]
+        wants_json = request.accept_mimetypes.best == 'application/json'
+        if not text:
+            return ({'error': 'Message is empty'}, 400) if wants_json else redirect(url_for('contact'))
+        user = User.query.get_or_404(user_id)
+        msg = Message(user_id=user.id, user_name=user.name, user_email=user.email, text=text, sender='student')
+        db.session.add(msg)
         db.session.commit()
+        if wants_json:
+            return message_json(msg), 201
+        return redirect(url_for('contact', sent=1))
+
+    before_id = request.args.get('before', type=int)
+    messages, has_more = contact_messages_page(user_id, before_id=before_id)
+    if before_id is None:
+        mark_admin_replies_seen(user_id, messages)
+
+    badges = get_header_badges(user_id)
+    return render_template(
+        'contact.html',
+        message='Message sent to admin' if request.args.get('sent') else None,
+        messages=messages,
+        has_more=has_more,
+        is_latest=before_id is None,
+        unread_count=badges['unread_count']
+    )
+
+
+@app.route('/contact/messages')
+def contact_messages():
+    if not is_user_logged_in():
+        return ({'error': 'Not logged in'}, 401)
+    user_id = session['user_id']
+    since_id = request.args.get('since_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    messages, has_more = contact_messages_page(user_id, before_id=before_id, since_id=since_id)
+    if since_id is not None:
+        mark_admin_replies_seen(user_id, messages)
+    return {'messages': [message_json(msg) for msg in messages], 'has_more': has_more}
+
+
+def visible_events_after(user_id, after_id, limit=EVENT_QUEUE_SIZE):
+    cohort_ids = db.select(CohortMember.cohort_id).where(CohortMember.user_id == user_id)
+    return LiveEvent.query.filter(
+        LiveEvent.id > after_id,
+        db.or_(
+            db.and_(LiveEvent.user_id.is_(None), LiveEvent.cohort_id.is_(None)),
+            LiveEvent.user_id == user_id,
+            LiveEvent.cohort_id.in_(cohort_ids)
+        )
+    ).order_by(LiveEvent.id).limit(limit).all()
+
+
+@app.route('/events/poll')
+def events_poll():
+    # Short-polling fallback for tabs whose /events stream was refused; each
+    # call is one indexed query and never holds the thread.
+    if not is_user_logged_in():
+        return ('', 401)
+    after = request.args.get('after', type=int)
+    if after is None:
+        return {'events': [], 'last_id': db.session.query(db.func.max(LiveEvent.id)).scalar() or 0}
+    rows = visible_events_after(session['user_id'], after)
+    events = [{'id': row.id, 'kind': row.kind, 'data': json.loads(row.payload)} for row in rows]
+    return {'events': events, 'last_id': rows[-1].id if rows else after}
 
-    unread_count = get_unread_count(user.id)
-    return render_template('contact.html', message=message, messages=user_messages, unread_count=unread_count)
+
+@app.route('/events')
+def events():
+    if not is_user_logged_in():
+        return ('', 401)
+
+    ensure_event_poller()
+    user_id = session['user_id']
+    q = subscribe_events(user_id)
+    if q is None:
+        # No stream thread free; the page polls /events/poll and retries the
+        # stream later (see live-events.js).
+        retry_seconds = app.config['EVENTS_RETRY_SECONDS']
+        response = Response(f'retry: {retry_seconds * 1000}\n\n', status=503, mimetype='text/event-stream')
+        response.headers['Retry-After'] = str(retry_seconds)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    backlog = []
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    if last_event_id.isdigit():
+        backlog = [(row.id, row.kind, row.payload) for row in visible_events_after(user_id, int(last_event_id))]
+    db.session.remove()
+
+    response = Response(stream_events(user_id, q, backlog), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route('/dashboard')
+@read_replica
 def dashboard():
     if not is_user_logged_in():
         return redirect(url_for('login'))
     subjects = Subject.query.order_by(Subject.name).all()
     user_id = session['user_id']
-    unread_count = get_unread_count(user_id)
-    admin_reply_unread = get_unread_admin_replies_count(user_id)
-    completed_videos = VideoCompletion.query.filter_by(user_id=user_id).all()
-    completed_video_ids = {c.video_id for c in completed_videos}
-
-    progress = {}
-    for subject in subjects:
-        topics = Topic.query.filter_by(subject_id=subject.id).all()
-        total_videos = 0
-        completed_count = 0
-        for topic in topics:
-            videos = Video.query.filter_by(topic_id=topic.id).all()
-            total_videos += len(videos)
-            completed_count += sum(1 for v in videos if v.id in completed_video_ids)
-        percent = 0
-        if total_videos > 0:
-            percent = int((completed_count / total_videos) * 100)
-        progress[subject.id] = {
-            'completed': completed_count,
-            'total': total_videos,
-            'percent': percent
-        }
+    badges = get_header_badges(user_id)
+    progress = subject_progress(user_id, subjects)
 
     return render_template(
         'subjects.html',
         subjects=subjects,
         progress=progress,
-        unread_count=unread_count,
-        admin_reply_unread=admin_reply_unread
+        unread_count=badges['unread_count'],
+        admin_reply_unread=badges['admin_reply_unread']
     )
 
 
 @app.route('/subjects')
+@read_replica
 def subjects():
     if not is_user_logged_in():
         return redirect(url_for('login'))
     subjects = Subject.query.order_by(Subject.name).all()
     user_id = session['user_id']
-    unread_count = get_unread_count(user_id)
-    admin_reply_unread = get_unread_admin_replies_count(user_id)
-    completed_videos = VideoCompletion.query.filter_by(user_id=user_id).all()
-    completed_video_ids = {c.video_id for c in completed_videos}
-
-    progress = {}
-    for subject in subjects:
-        topics = Topic.query.filter_by(subject_id=subject.id).all()
-        total_videos = 0
-        completed_count = 0
-        for topic in topics:
-            videos = Video.query.filter_by(topic_id=topic.id).all()
-            total_videos += len(videos)
-            completed_count += sum(1 for v in videos if v.id in completed_video_ids)
-        percent = 0
-        if total_videos > 0:
-            percent = int((completed_count / total_videos) * 100)
-        progress[subject.id] = {
-            'completed': completed_count,
-            'total': total_videos,
-            'percent': percent
-        }
+    badges = get_header_badges(user_id)
+    progress = subject_progress(user_id, subjects)
 
     return render_template(
         'subjects.html',
         subjects=subjects,
         progress=progress,
-        unread_count=unread_count,
-        admin_reply_unread=admin_reply_unread
+        unread_count=badges['unread_count'],
+        admin_reply_unread=badges['admin_reply_unread']
     )
 
 
 @app.route('/subjects/<int:subject_id>/topics')
+@read_replica
 def topics(subject_id):
     if not is_user_logged_in():
         return redirect(url_for('login'))
     subject = Subject.query.get_or_404(subject_id)
     topic_list = Topic.query.filter_by(subject_id=subject_id).order_by(Topic.name).all()
     user_id = session['user_id']
-    unread_count = get_unread_count(user_id)
-    admin_reply_unread = get_unread_admin_replies_count(user_id)
-    completed_videos = VideoCompletion.query.filter_by(user_id=user_id).all()
-    completed_video_ids = {c.video_id for c in completed_videos}
+    badges = get_header_badges(user_id)
+    totals = dict(db.session.query(Video.topic_id, db.func.count(Video.id)).join(
+        Topic, Topic.id == Video.topic_id
+    ).filter(Topic.subject_id == subject_id).group_by(Video.topic_id).all())
+    completed = dict(db.session.query(Video.topic_id, db.func.count(db.distinct(VideoCompletion.video_id))).join(
+        Topic, Topic.id == Video.topic_id
+    ).join(
+        VideoCompletion, VideoCompletion.video_id == Video.id
+    ).filter(Topic.subject_id == subject_id, VideoCompletion.user_id == user_id).group_by(Video.topic_id).all())
+    done_topic_ids = {
+        topic_id for (topic_id,) in db.session.query(TopicCompletion.topic_id).join(
+            Topic, Topic.id == TopicCompletion.topic_id
+        ).filter(Topic.subject_id == subject_id, TopicCompletion.user_id == user_id)
+    }
+    subject_completed = SubjectCompletion.query.filter_by(user_id=user_id, subject_id=subject_id).first() is not None
+    buffered_topics = set()
+    for _, topic_id, pending_subject_id, delta in pending_progress_deltas(user_id):
+        if pending_subject_id == subject_id:
+            completed[topic_id] = completed.get(topic_id, 0) + delta
+            buffered_topics.add(topic_id)
     topic_progress = {}
     for topic in topic_list:
-        videos = Video.query.filter_by(topic_id=topic.id).all()
-        total_videos = len(videos)
-        completed_count = sum(1 for v in videos if v.id in completed_video_ids)
+        total = totals.get(topic.id, 0)
+        done = topic.id in done_topic_ids
+        if topic.id in buffered_topics:
+            done = total > 0 and completed.get(topic.id, 0) >= total
         topic_progress[topic.id] = {
-            'completed': completed_count,
-            'total': total_videos,
-            'done': total_videos > 0 and completed_count == total_videos
+            'completed': completed.get(topic.id, 0),
+            'total': total,
+            'done': done
         }
     return render_template(
         'topics.html',
         subject=subject,
+        subject_completed=subject_completed,
         topics=topic_list,
         topic_progress=topic_progress,
-        unread_count=unread_count,
-        admin_reply_unread=admin_reply_unread
+        unread_count=badges['unread_count'],
+        admin_reply_unread=badges['admin_reply_unread']
     )
 
 
 @app.route('/topics/<int:topic_id>/learning')
+@read_replica
 def learning(topic_id):
     if not is_user_logged_in():
         return redirect(url_for('login'))
-    topic = Topic.query.get_or_404(topic_id)
-    videos = Video.query.filter_by(topic_id=topic_id).all()
-    notes = Note.query.filter_by(topic_id=topic_id).all()
-    questions = Question.query.filter_by(topic_id=topic_id).all()
+    # The topic plus one IN query per child collection; joining all three
+    # would return videos x notes x questions rows.
+    topic = Topic.query.options(
+        selectinload(Topic.videos),
+        selectinload(Topic.notes),
+        selectinload(Topic.questions)
+    ).filter(Topic.id == topic_id).first_or_404()
+    videos = sorted(topic.videos, key=lambda v: v.id)
+    notes = sorted(topic.notes, key=lambda n: n.id)
+    questions = sorted(topic.questions, key=lambda q: q.id)
     user_id = session['user_id']
-    unread_count = get_unread_count(user_id)
-    admin_reply_unread = get_unread_admin_replies_count(user_id)
-    completed_videos = VideoCompletion.query.filter_by(user_id=user_id).all()
-    completed_video_ids = {c.video_id for c in completed_videos}
+    badges = get_header_badges(user_id)
+    completed_video_ids = set()
+    if videos:
+        completed_video_ids = {
+            video_id for (video_id,) in db.session.query(VideoCompletion.video_id).filter(
+                VideoCompletion.user_id == user_id,
+                VideoCompletion.video_id.in_([v.id for v in videos])
+            )
+        }
+        for video_id, (completed, _, _) in pending_progress(user_id).items():
+            if completed:
+                completed_video_ids.add(video_id)
+            else:
+                completed_video_ids.discard(video_id)
     topic_completed = len(videos) > 0 and all(v.id in completed_video_ids for v in videos)
     return render_template(
         'learning.html',
@@ -725,21 +3843,47 @@ def learning(topic_id):
         questions=questions,
         completed_video_ids=completed_video_ids,
         topic_completed=topic_completed,
-        unread_count=unread_count,
-        admin_reply_unread=admin_reply_unread
+        unread_count=badges['unread_count'],
+        admin_reply_unread=badges['admin_reply_unread']
     )
 
 
+def _video_location(video_id):
+    row = db.session.query(Video.id, Video.topic_id, Topic.subject_id).join(
+        Topic, Topic.id == Video.topic_id
+    ).filter(Video.id == video_id).first()
+    if row is None:
+        abort(404)
+    return tuple(row)
+
+
 @app.route('/topics/<int:topic_id>/complete', methods=['POST'])
 def complete_topic(topic_id):
     if not is_user_logged_in():
         return redirect(url_for('login'))
 
+    # Completing a topic marks all of its videos done; TopicCompletion follows.
     user_id = session['user_id']
-    existing = TopicCompletion.query.filter_by(user_id=user_id, topic_id=topic_id).first()
-    if not existing:
-        db.session.add(TopicCompletion(user_id=user_id, topic_id=topic_id))
-        db.session.commit()
+    topic = Topic.query.get_or_404(topic_id)
+    if app.config['PROGRESS_BUFFER_ENABLED']:
+        buffer_progress(user_id, [
+            (video_id, topic.id, topic.subject_id, True)
+            for (video_id,) in db.session.query(Video.id).filter(Video.topic_id == topic.id)
+        ])
+        return redirect(url_for('learning', topic_id=topic_id))
+    done_ids = {
+        video_id for (video_id,) in db.session.query(VideoCompletion.video_id).join(
+            Video, Video.id == VideoCompletion.video_id
+        ).filter(VideoCompletion.user_id == user_id, Video.topic_id == topic.id)
+    }
+    for (video_id,) in db.session.query(Video.id).filter(Video.topic_id == topic.id):
+        if video_id not in done_ids:
+            db.session.add(VideoCompletion(user_id=user_id, video_id=video_id))
+            bump_rollup('video', video_id, 1)
+            bump_daily('video_completions', 1)
+    db.session.flush()
+    sync_user_completion(user_id, topic.id)
+    db.session.commit()
     return redirect(url_for('learning', topic_id=topic_id))
 
 
@@ -749,9 +3893,17 @@ def complete_video(video_id):
         return redirect(url_for('login'))
 
     user_id = session['user_id']
-    existing = VideoCompletion.query.filter_by(user_id=user_id, video_id=video_id).first()
+    if app.config['PROGRESS_BUFFER_ENABLED']:
+        buffer_progress(user_id, [(*_video_location(video_id), True)])
+        return redirect(request.referrer or url_for('subjects'))
+    video = Video.query.get_or_404(video_id)
+    existing = VideoCompletion.query.filter_by(user_id=user_id, video_id=video.id).first()
     if not existing:
-        db.session.add(VideoCompletion(user_id=user_id, video_id=video_id))
+        db.session.add(VideoCompletion(user_id=user_id, video_id=video.id))
+        bump_rollup('video', video.id, 1)
+        bump_daily('video_completions', 1)
+        db.session.flush()
+        sync_user_completion(user_id, video.topic_id)
         db.session.commit()
     return redirect(request.referrer or url_for('subjects'))
 
@@ -762,20 +3914,105 @@ def uncomplete_video(video_id):
         return redirect(url_for('login'))
 
     user_id = session['user_id']
-    VideoCompletion.query.filter_by(user_id=user_id, video_id=video_id).delete()
+    if app.config['PROGRESS_BUFFER_ENABLED']:
+        buffer_progress(user_id, [(*_video_location(video_id), False)])
+        return redirect(request.referrer or url_for('subjects'))
+    removed = VideoCompletion.query.filter_by(user_id=user_id, video_id=video_id).delete()
+    video = db.session.get(Video, video_id)
+    if video:
+        if removed:
+            bump_rollup('video', video_id, -removed)
+            bump_daily('video_uncompletions', removed)
+        sync_user_completion(user_id, video.topic_id)
     db.session.commit()
     return redirect(request.referrer or url_for('subjects'))
 
 
+@app.route('/topics/<int:topic_id>/quiz', methods=['GET', 'POST'])
+def quiz(topic_id):
+    if not is_user_logged_in():
+        return redirect(url_for('login'))
+    user_id = session['user_id']
+    topic = Topic.query.get_or_404(topic_id)
+
+    if request.method == 'POST':
+        quiz_set = load_quiz_set(request.form.get('quiz_set_id', type=int))
+        if quiz_set is None or quiz_set['topic_id'] != topic.id:
+            return redirect(url_for('quiz', topic_id=topic.id))
+        score, answers, results = grade_quiz(quiz_set, request.form)
+        record_quiz_attempt(user_id, quiz_set, score, answers, results)
+        db.session.commit()
+        return render_template(
+            'quiz.html',
+            topic=topic,
+            quiz_set=quiz_set,
+            results={r['question_id']: r for r in results},
+            score=score,
+            unread_count=get_header_badges(user_id)['unread_count']
+        )
+
+    set_ids = [set_id for (set_id,) in db.session.query(QuizSet.id).filter_by(topic_id=topic.id, active=True)]
+    quiz_set = load_quiz_set(random.choice(set_ids)) if set_ids else None
+    return render_template(
+        'quiz.html',
+        topic=topic,
+        quiz_set=quiz_set,
+        results=None,
+        score=None,
+        unread_count=get_header_badges(user_id)['unread_count']
+    )
+
+
+@app.route('/files/<path:key>')
+def download_file(key):
+    if not (is_user_logged_in() or is_admin_logged_in()):
+        return redirect(url_for('login'))
+    if not key.startswith(('uploads/', 'certificates/')) or '..' in key.split('/'):
+        abort(404)
+    if key.startswith('certificates/') and not is_admin_logged_in():
+        if not Certificate.query.filter_by(file_path=key, user_id=session['user_id']).first():
+            abort(404)
+    return storage.response(key)
+
+
+@app.route('/subjects/<int:subject_id>/certificate')
+def certificate(subject_id):
+    if not is_user_logged_in():
+        return redirect(url_for('login'))
+    user_id = session['user_id']
+    subject = Subject.query.get_or_404(subject_id)
+    if not SubjectCompletion.query.filter_by(user_id=user_id, subject_id=subject.id).first():
+        return redirect(url_for('topics', subject_id=subject.id))
+
+    cert = queue_certificate(user_id, subject.id)
+    db.session.commit()
+    if cert.status == 'ready' and cert.file_path and storage.exists(cert.file_path):
+        g.pop('new_certificates', None)
+        return redirect(url_for('download_file', key=cert.file_path))
+    try:
+        submit_certificate(cert)
+    except Exception:
+        # The pending page refreshes, so the next request tries again.
+        app.logger.exception('Could not queue certificate rendering')
+    g.pop('new_certificates', None)
+    response = app.make_response((
+        render_template('certificate_pending.html', subject=subject),
+        202
+    ))
+    response.headers['Refresh'] = '3'
+    return response
+
+
 @app.route('/subjects/<int:subject_id>/interview')
+@read_replica
 def interview(subject_id):
     if not is_user_logged_in():
         return redirect(url_for('login'))
     subject = Subject.query.get_or_404(subject_id)
     items = InterviewPrep.query.filter_by(subject_id=subject_id).order_by(InterviewPrep.id.desc()).all()
     user_id = session['user_id']
-    unread_count = get_unread_count(user_id)
-    return render_template('interview_prep.html', subject=subject, items=items, unread_count=unread_count)
+    badges = get_header_badges(user_id)
+    return render_template('interview_prep.html', subject=subject, items=items, unread_count=badges['unread_count'])
 
 
 @app.route('/admin', methods=['GET', 'POST'])
@@ -795,9 +4032,10 @@ def admin():
 
         if form_type == 'topic':
             name = request.form.get('topic_name', '').strip()
-            subject_id = request.form.get('subject_id')
-            if name and subject_id:
-                db.session.add(Topic(name=name, subject_id=int(subject_id)))
+            subject_id = request.form.get('subject_id', type=int)
+            subject = db.session.get(Subject, subject_id) if subject_id else None
+            if name and subject:
+                db.session.add(Topic(name=name, subject_id=subject.id))
                 db.session.commit()
             return redirect(url_for('admin'))
 
@@ -805,59 +4043,89 @@ def admin():
             title = request.form.get('video_title', '').strip()
             youtube_id = request.form.get('youtube_id', '').strip()
             topic_id = request.form.get('topic_id')
-            if title and youtube_id and topic_id:
-                db.session.add(Video(title=title, youtube_id=youtube_id, topic_id=int(topic_id)))
+            topic = db.session.get(Topic, int(topic_id)) if topic_id else None
+            if title and youtube_id and topic:
+                db.session.add(Video(title=title, youtube_id=youtube_id, topic_id=topic.id))
+                resync_topic_completions(topic.id, topic.subject_id)
                 db.session.commit()
             return redirect(url_for('admin'))
 
         if form_type == 'note':
             title = request.form.get('note_title', '').strip()
-            topic_id = request.form.get('topic_id')
+            topic_id = request.form.get('topic_id', type=int)
+            topic = db.session.get(Topic, topic_id) if topic_id else None
             file = request.files.get('note_file')
 
-            if title and topic_id and file and file.filename.lower().endswith('.pdf'):
-                filename = secure_filename(file.filename)
-                save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(save_path)
-
-                relative_path = os.path.join('uploads', 'notes', filename).replace('\\', '/')
-                db.session.add(Note(title=title, file_path=relative_path, topic_id=int(topic_id)))
+            if title and topic and file and file.filename.lower().endswith('.pdf'):
+                key = save_upload(file, 'uploads/notes', 'note')
+                db.session.add(Note(title=title, file_path=key, topic_id=topic.id))
                 db.session.commit()
 
             return redirect(url_for('admin'))
 
         if form_type == 'question':
             text = request.form.get('question_text', '').strip()
-            topic_id = request.form.get('topic_id')
-            if text and topic_id:
-                db.session.add(Question(text=text, topic_id=int(topic_id)))
+            topic_id = request.form.get('topic_id', type=int)
+            topic = db.session.get(Topic, topic_id) if topic_id else None
+            choices, answer = parse_question_choices(request.form)
+            if text and topic:
+                db.session.add(Question(text=text, topic_id=topic.id, choices=choices, answer=answer))
                 db.session.commit()
             return redirect(url_for('admin'))
 
         if form_type == 'notification':
             title = request.form.get('notification_title', '').strip()
             body = request.form.get('notification_body', '').strip()
+            audience = request.form.get('audience', 'all')
+            cohort_id = request.form.get('cohort_id', type=int)
+            user_ids = existing_user_ids(request.form.getlist('recipient_ids', type=int))
+            if audience == 'cohort' and not (cohort_id and db.session.get(Cohort, cohort_id)):
+                return redirect(url_for('admin'))
+            if audience == 'users' and not user_ids:
+                return redirect(url_for('admin'))
+            if audience not in ('cohort', 'users'):
+                audience = 'all'
+            if audience != 'cohort':
+                cohort_id = None
             if title and body:
-                db.session.add(Notification(title=title, body=body))
+                create_notification(title, body, audience=audience, cohort_id=cohort_id, user_ids=user_ids)
                 db.session.commit()
+                invalidate_header_badges()
+            return redirect(url_for('admin'))
+
+        if form_type == 'cohort':
+            name = request.form.get('cohort_name', '').strip()
+            member_ids = request.form.getlist('member_ids', type=int)
+            if name:
+                if Cohort.query.filter_by(name=name).first():
+                    flash(f'A cohort named "{name}" already exists.')
+                    return redirect(url_for('admin'))
+                cohort = Cohort(name=name)
+                db.session.add(cohort)
+                db.session.flush()
+                for user_id in existing_user_ids(member_ids):
+                    db.session.add(CohortMember(cohort_id=cohort.id, user_id=user_id))
+                try:
+                    db.session.commit()
+                except IntegrityError:
+                    # Another admin created the same name in the meantime.
+                    db.session.rollback()
+                    flash(f'A cohort named "{name}" already exists.')
             return redirect(url_for('admin'))
 
         if form_type == 'interview':
-            subject_id = request.form.get('subject_id')
+            subject_id = request.form.get('subject_id', type=int)
+            subject = db.session.get(Subject, subject_id) if subject_id else None
             title = request.form.get('interview_title', '').strip()
             content = request.form.get('interview_content', '').strip()
             file = request.files.get('interview_file')
-            pdf_path = None
-
-            if file and file.filename.lower().endswith('.pdf'):
-                filename = secure_filename(file.filename)
-                save_path = os.path.join(app.config['INTERVIEW_UPLOAD_FOLDER'], filename)
-                file.save(save_path)
-                pdf_path = os.path.join('uploads', 'interview', filename).replace('\\', '/')
 
-            if subject_id and title and content:
+            if subject and title and content:
+                pdf_path = None
+                if file and file.filename.lower().endswith('.pdf'):
+                    pdf_path = save_upload(file, 'uploads/interview', 'interview')
                 db.session.add(InterviewPrep(
-                    subject_id=int(subject_id),
+                    subject_id=subject.id,
                     title=title,
                     content=content,
                     pdf_path=pdf_path
@@ -874,6 +4142,11 @@ def admin():
     students = User.query.order_by(User.name).all()
     notifications = Notification.query.order_by(Notification.id.desc()).all()
     interviews = InterviewPrep.query.order_by(InterviewPrep.id.desc()).all()
+    cohorts = Cohort.query.order_by(Cohort.name).all()
+    question_stats = {stat.question_id: stat for stat in QuestionStat.query.all()}
+    quiz_set_counts = dict(db.session.query(QuizSet.topic_id, db.func.count(QuizSet.id)).filter(
+        QuizSet.active.is_(True)
+    ).group_by(QuizSet.topic_id).all())
     messages_by_user = {}
     admin_seen = session.get('admin_seen_msgs', {})
     for msg in messages:
@@ -907,6 +4180,9 @@ def admin():
         students=students,
         notifications=notifications,
         interviews=interviews,
+        cohorts=cohorts,
+        question_stats=question_stats,
+        quiz_set_counts=quiz_set_counts,
         admin_unread_msg=any(t['new'] for t in messages_by_user.values())
     )
     # Update session seen ids after viewing
@@ -920,9 +4196,13 @@ def admin():
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
     if request.method == 'POST':
+        retry_after = rate_limit('admin_login_ip', client_ip())
+        if retry_after:
+            return too_many_requests('admin_login.html', retry_after)
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
         if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
+            regenerate_session()
             session['is_admin'] = True
             return redirect(url_for('admin'))
         return render_template('admin_login.html', error='Invalid admin credentials')
@@ -935,6 +4215,46 @@ def admin_logout():
     return redirect(url_for('admin_login'))
 
 
+@app.route('/admin/analytics')
+def admin_analytics():
+    guard = require_admin()
+    if guard:
+        return guard
+    return render_template('admin_analytics.html', summary=analytics_summary())
+
+
+@app.route('/admin/analytics.json')
+def admin_analytics_json():
+    guard = require_admin()
+    if guard:
+        return guard
+    days = min(max(request.args.get('days', 30, type=int), 1), 365)
+    return analytics_summary(days=days)
+
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
+    guard = require_admin()
+    if guard:
+        return guard
+    if request.method == 'POST':
+        try:
+            set_profile_sample_rate(float(request.form.get('sample_rate', '0')))
+        except ValueError:
+            return {'error': 'sample_rate must be a number'}, 400
+    return {'sample_rate': get_profile_sample_rate(), 'profiles': list_profiles()}
+
+
+@app.route('/admin/profiling/<path:filename>')
+def admin_profile_download(filename):
+    guard = require_admin()
+    if guard:
+        return guard
+    if not filename.endswith('.folded'):
+        return ('', 404)
+    return send_from_directory(app.config['PROFILE_DIR'], filename, mimetype='text/plain', as_attachment=True)
+
+
 @app.route('/admin/messages/<int:user_id>/reply', methods=['POST'])
 def admin_reply(user_id):
     guard = require_admin()
@@ -950,7 +4270,9 @@ def admin_reply(user_id):
             text=text,
             sender='admin'
         ))
+        publish_event('reply', user_id=user.id)
         db.session.commit()
+        invalidate_header_badges(user.id)
     return redirect(url_for('admin'))
 
 
@@ -989,9 +4311,34 @@ def delete_notification(notification_id):
     if guard:
         return guard
     notification = Notification.query.get_or_404(notification_id)
-    NotificationRead.query.filter_by(notification_id=notification.id).delete()
-    db.session.delete(notification)
+    delete_notifications([notification.id])
     db.session.commit()
+    invalidate_header_badges()
+    return redirect(url_for('admin'))
+
+
+@app.route('/admin/cohorts/<int:cohort_id>/delete', methods=['POST'])
+def delete_cohort(cohort_id):
+    guard = require_admin()
+    if guard:
+        return guard
+    cohort = Cohort.query.get_or_404(cohort_id)
+    # Cohort notifications and events are only meant for its members, so they
+    # go with the cohort rather than falling back to everyone. Older rows sent
+    # to other audiences may still carry the cohort id; they only lose it.
+    notification_ids = list(db.session.scalars(db.select(Notification.id).where(
+        Notification.cohort_id == cohort.id,
+        Notification.audience == 'cohort'
+    )))
+    if notification_ids:
+        delete_notifications(notification_ids)
+    Notification.query.filter_by(cohort_id=cohort.id).update({'cohort_id': None}, synchronize_session=False)
+    # Only cohort-audience events are published with a cohort id.
+    LiveEvent.query.filter_by(cohort_id=cohort.id).delete(synchronize_session=False)
+    CohortMember.query.filter_by(cohort_id=cohort.id).delete(synchronize_session=False)
+    Cohort.query.filter_by(id=cohort.id).delete(synchronize_session=False)
+    db.session.commit()
+    invalidate_header_badges()
     return redirect(url_for('admin'))
 
 
@@ -1010,13 +4357,13 @@ def edit_interview(interview_id):
     if content:
         interview.content = content
 
+    replaced_path = None
     if file and file.filename.lower().endswith('.pdf'):
-        filename = secure_filename(file.filename)
-        save_path = os.path.join(app.config['INTERVIEW_UPLOAD_FOLDER'], filename)
-        file.save(save_path)
-        interview.pdf_path = os.path.join('uploads', 'interview', filename).replace('\\', '/')
+        replaced_path = interview.pdf_path
+        interview.pdf_path = save_upload(file, 'uploads/interview', 'interview')
 
     db.session.commit()
+    remove_stored_files([replaced_path])
     return redirect(url_for('admin'))
 
 
@@ -1026,12 +4373,10 @@ def delete_interview(interview_id):
     if guard:
         return guard
     interview = InterviewPrep.query.get_or_404(interview_id)
-    if interview.pdf_path:
-        file_to_remove = os.path.join(app.static_folder, interview.pdf_path)
-        if os.path.exists(file_to_remove):
-            os.remove(file_to_remove)
+    pdf_path = interview.pdf_path
     db.session.delete(interview)
     db.session.commit()
+    remove_stored_files([pdf_path])
     return redirect(url_for('admin'))
 
 
@@ -1041,8 +4386,9 @@ def delete_subject(subject_id):
     if guard:
         return guard
     subject = Subject.query.get_or_404(subject_id)
-    db.session.delete(subject)
+    file_paths = delete_subject_content(subject.id)
     db.session.commit()
+    remove_stored_files(file_paths)
     return redirect(url_for('admin'))
 
 
@@ -1065,8 +4411,11 @@ def delete_topic(topic_id):
     if guard:
         return guard
     topic = Topic.query.get_or_404(topic_id)
-    db.session.delete(topic)
+    subject_id = topic.subject_id
+    note_paths = delete_topics([topic.id])
+    resync_subject_completions(subject_id)
     db.session.commit()
+    remove_stored_files(note_paths)
     return redirect(url_for('admin'))
 
 
@@ -1089,7 +4438,9 @@ def delete_video(video_id):
     if guard:
         return guard
     video = Video.query.get_or_404(video_id)
-    db.session.delete(video)
+    topic = video.topic
+    delete_videos([video.id])
+    resync_topic_completions(topic.id, topic.subject_id)
     db.session.commit()
     return redirect(url_for('admin'))
 
@@ -1116,12 +4467,10 @@ def delete_note(note_id):
     if guard:
         return guard
     note = Note.query.get_or_404(note_id)
-    if note.file_path:
-        file_to_remove = os.path.join(app.static_folder, note.file_path)
-        if os.path.exists(file_to_remove):
-            os.remove(file_to_remove)
+    file_path = note.file_path
     db.session.delete(note)
     db.session.commit()
+    remove_stored_files([file_path])
     return redirect(url_for('admin'))
 
 
@@ -1144,7 +4493,22 @@ def delete_question(question_id):
     if guard:
         return guard
     question = Question.query.get_or_404(question_id)
-    db.session.delete(question)
+    delete_questions([question.id])
+    db.session.commit()
+    return redirect(url_for('admin'))
+
+
+@app.route('/admin/topics/<int:topic_id>/quiz_sets', methods=['POST'])
+def generate_topic_quiz_sets(topic_id):
+    guard = require_admin()
+    if guard:
+        return guard
+    topic = Topic.query.get_or_404(topic_id)
+    count = min(max(request.form.get('set_count', 5, type=int), 1), 50)
+    size = max(request.form.get('set_size', 0, type=int), 0)
+    if request.form.get('replace'):
+        QuizSet.query.filter_by(topic_id=topic.id, active=True).update({'active': False}, synchronize_session=False)
+    generate_quiz_sets(topic.id, count, size)
     db.session.commit()
     return redirect(url_for('admin'))
 
@@ -1156,9 +4520,13 @@ def edit_question(question_id):
         return guard
     question = Question.query.get_or_404(question_id)
     text = request.form.get('question_text', '').strip()
+    choices, answer = parse_question_choices(request.form)
     if text:
         question.text = text
-        db.session.commit()
+    if choices:
+        question.choices = choices
+        question.answer = answer
+    db.session.commit()
     return redirect(url_for('admin'))
 
 
@@ -0,0 +1,113 @@
+(() => {
+    const thread = document.querySelector('[data-contact-thread]');
+    const form = document.querySelector('[data-contact-form]');
+    if (!thread || !form || !window.fetch) return;
+
+    const list = thread.querySelector('[data-contact-list]');
+    const status = document.querySelector('[data-contact-status]');
+    const messagesUrl = thread.dataset.messagesUrl;
+    const isLive = thread.dataset.live === '1';
+    const pollMs = 15000;
+    let newestId = parseInt(thread.dataset.newestId, 10) || 0;
+    let oldestId = parseInt(thread.dataset.oldestId, 10) || 0;
+    let polling = false;
+
+    const renderMessage = (msg) => {
+        const row = document.createElement('div');
+        const isAdmin = msg.sender === 'admin';
+        row.dataset.messageId = msg.id;
+        row.style.cssText = `display: flex; justify-content: ${isAdmin ? 'flex-start' : 'flex-end'}; margin-bottom: 8px;`;
+
+        const bubble = document.createElement('div');
+        bubble.style.cssText = 'padding: 10px 12px; border-radius: 10px; max-width: 80%; color: #0f172a; '
+            + (isAdmin
+                ? 'background: #dbeafe; border: 1px solid #60a5fa;'
+                : 'background: #e0f2fe; border: 1px solid rgba(148, 163, 184, 0.4);');
+        if (isAdmin) {
+            const label = document.createElement('div');
+            label.style.cssText = 'font-size: 11px; font-weight: 700; color: #2563eb; margin-bottom: 4px;';
+            label.textContent = 'Admin';
+            bubble.appendChild(label);
+        }
+        bubble.appendChild(document.createTextNode(msg.text));
+        row.appendChild(bubble);
+        return row;
+    };
+
+    const append = (messages) => {
+        messages.forEach((msg) => {
+            if (list.querySelector(`[data-message-id="${msg.id}"]`)) return;
+            list.appendChild(renderMessage(msg));
+            newestId = Math.max(newestId, msg.id);
+        });
+        if (messages.length) thread.style.display = '';
+    };
+
+    const poll = async () => {
+        if (!isLive || polling) return;
+        polling = true;
+        try {
+            let hasMore = true;
+            while (hasMore) {
+                const response = await fetch(`${messagesUrl}?since_id=${newestId}`, { headers: { Accept: 'application/json' } });
+                if (!response.ok) return;
+                const data = await response.json();
+                append(data.messages);
+                hasMore = data.has_more;
+            }
+        } catch (err) {
+            // Network hiccup; the next poll catches up.
+        } finally {
+            polling = false;
+        }
+    };
+
+    form.addEventListener('submit', async (event) => {
+        if (!isLive) return;
+        event.preventDefault();
+        const textarea = form.querySelector('textarea');
+        const button = form.querySelector('button');
+        button.disabled = true;
+        try {
+            const response = await fetch(form.action, {
+                method: 'POST',
+                headers: { Accept: 'application/json' },
+                body: new FormData(form)
+            });
+            if (!response.ok) return;
+            const msg = await response.json();
+            await poll();
+            append([msg]);
+            textarea.value = '';
+            if (status) {
+                status.textContent = 'Message sent to admin';
+                status.style.display = '';
+            }
+        } finally {
+            button.disabled = false;
+        }
+    });
+
+    const older = thread.querySelector('[data-contact-older]');
+    if (older) {
+        older.querySelector('a').addEventListener('click', async (event) => {
+            event.preventDefault();
+            const response = await fetch(`${messagesUrl}?before_id=${oldestId}`, { headers: { Accept: 'application/json' } });
+            if (!response.ok) return;
+            const data = await response.json();
+            const first = list.firstChild;
+            data.messages.forEach((msg) => list.insertBefore(renderMessage(msg), first));
+            if (data.messages.length) oldestId = data.messages[0].id;
+            if (!data.has_more) older.remove();
+        });
+    }
+
+    if (!isLive) return;
+
+    // Admin replies arrive as live events when they are available; the
+    // interval is only a fallback, and both fetch just the new messages.
+    if (window.LiveEvents) window.LiveEvents.on('reply', poll);
+    setInterval(() => {
+        if (!document.hidden) poll();
+    }, pollMs);
+})();
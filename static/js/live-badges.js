@@ -0,0 +1,29 @@
+(() => {
+    if (!window.LiveEvents) return;
+
+    const notifLink = document.querySelector('[data-live-badge="notifications"]');
+    const replyLink = document.querySelector('[data-live-badge="replies"]');
+    if (!notifLink && !replyLink) return;
+
+    const setBadge = (link, value) => {
+        let badge = link.querySelector('.notif-badge');
+        if (!badge) {
+            badge = document.createElement('span');
+            badge.className = 'notif-badge';
+            link.appendChild(badge);
+        }
+        badge.textContent = value;
+    };
+
+    window.LiveEvents.on('notification', () => {
+        if (!notifLink) return;
+        const badge = notifLink.querySelector('.notif-badge');
+        const current = badge ? parseInt(badge.textContent, 10) || 0 : 0;
+        setBadge(notifLink, current + 1);
+    });
+
+    window.LiveEvents.on('reply', () => {
+        if (!replyLink) return;
+        setBadge(replyLink, 1);
+    });
+})();
@@ -0,0 +1,78 @@
+(() => {
+    // One live-event connection per page. The /events stream is preferred;
+    // when the server refuses it (every stream slot busy) the page polls
+    // /events/poll instead and tries the stream again later.
+    const handlers = {};
+    const pollMs = 5000;
+    let source = null;
+    let lastId = null;
+    let pollTimer = null;
+    let started = false;
+
+    const dispatch = (kind, data) => {
+        (handlers[kind] || []).forEach((fn) => fn(data));
+    };
+
+    const poll = async () => {
+        pollTimer = null;
+        if (!document.hidden) {
+            try {
+                const query = lastId === null ? '' : `?after=${lastId}`;
+                const response = await fetch(`/events/poll${query}`, { headers: { Accept: 'application/json' } });
+                if (response.ok) {
+                    const data = await response.json();
+                    data.events.forEach((event) => dispatch(event.kind, event.data));
+                    lastId = data.last_id;
+                }
+            } catch (err) {
+                // Network hiccup; the next poll catches up.
+            }
+        }
+        if (!source) pollTimer = setTimeout(poll, pollMs);
+    };
+
+    const connect = () => {
+        if (!window.EventSource) {
+            poll();
+            return;
+        }
+        source = new EventSource('/events');
+        source.addEventListener('open', () => {
+            if (pollTimer) clearTimeout(pollTimer);
+            pollTimer = null;
+        });
+        Object.keys(handlers).forEach((kind) => listen(kind));
+        source.addEventListener('error', () => {
+            if (source.readyState !== EventSource.CLOSED) return;
+            // A 503 is not retried by the browser; poll until a slot frees up.
+            source = null;
+            if (!pollTimer) poll();
+            setTimeout(connect, 30000 + Math.random() * 30000);
+        });
+    };
+
+    const listen = (kind) => {
+        source.addEventListener(kind, (event) => {
+            lastId = Math.max(lastId || 0, parseInt(event.lastEventId, 10) || 0);
+            dispatch(kind, JSON.parse(event.data));
+        });
+    };
+
+    window.LiveEvents = {
+        on(kind, fn) {
+            if (!handlers[kind]) {
+                handlers[kind] = [];
+                if (source) listen(kind);
+            }
+            handlers[kind].push(fn);
+            if (!started) {
+                started = true;
+                setTimeout(connect, 0);
+            }
+        }
+    };
+
+    window.addEventListener('pagehide', () => {
+        if (source) source.close();
+    });
+})();
@@ -0,0 +1,11 @@
+(() => {
+    if (!('serviceWorker' in navigator)) return;
+    window.addEventListener('load', () => {
+        navigator.serviceWorker.register('/sw.js').catch(() => {});
+    });
+    // The page on screen came from the cache, but the session is gone; reload
+    // so the server can send the student to the login page.
+    navigator.serviceWorker.addEventListener('message', (event) => {
+        if (event.data && event.data.type === 'session-ended') window.location.reload();
+    });
+})();
@@ -0,0 +1,146 @@
+// Service worker for student pages. Served from /sw.js so its scope is the
+// whole site.
+//   static assets       stale-while-revalidate
+//   student pages       stale-while-revalidate, dropped after any form post
+//                       and as soon as the server stops treating us as logged in
+//   note/interview PDFs cache-first (storage keys never change)
+const VERSION = 'v1';
+const STATIC_CACHE = `learnhub-static-${VERSION}`;
+const PAGE_CACHE = `learnhub-pages-${VERSION}`;
+const FILE_CACHE = `learnhub-files-${VERSION}`;
+const CACHES = [STATIC_CACHE, PAGE_CACHE, FILE_CACHE];
+const PAGE_PATTERN = /^\/(dashboard|subjects(\/\d+\/(topics|interview))?|topics\/\d+\/learning)$/;
+const MAX_PAGES = 60;
+const MAX_FILES = 40;
+const PRIVATE_CACHES = [PAGE_CACHE, FILE_CACHE];
+const LOGIN_PATHS = ['/login', '/register', '/admin/login'];
+
+// Prefetches started by tap-feedback.js, so the navigation that follows a
+// moment later reuses the same response instead of asking again.
+const inFlight = new Map();
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil((async () => {
+        const names = await caches.keys();
+        await Promise.all(names.filter((name) => name.startsWith('learnhub-') && !CACHES.includes(name))
+            .map((name) => caches.delete(name)));
+        await self.clients.claim();
+    })());
+});
+
+// A page fetched this recently (usually by a tap prefetch) is served without
+// asking the server again.
+const FRESH_MS = 10000;
+
+const trim = async (cacheName, maxEntries) => {
+    const cache = await caches.open(cacheName);
+    const keys = await cache.keys();
+    await Promise.all(keys.slice(0, Math.max(keys.length - maxEntries, 0)).map((key) => cache.delete(key)));
+};
+
+const store = async (cacheName, key, response, maxEntries) => {
+    const headers = new Headers(response.headers);
+    headers.set('x-sw-fetched-at', String(Date.now()));
+    const cache = await caches.open(cacheName);
+    await cache.put(key, new Response(response.body, {
+        status: response.status,
+        statusText: response.statusText,
+        headers
+    }));
+    if (maxEntries) await trim(cacheName, maxEntries);
+};
+
+// A redirect to the login page or a 401/403 means the session is gone, so
+// nothing cached for the previous student may be shown again. (Other
+// redirects, such as /files/ to a signed S3 URL, are fine.)
+const sessionEnded = (response) => response.status === 401 || response.status === 403
+    || (response.redirected && LOGIN_PATHS.includes(new URL(response.url).pathname));
+
+const forgetStudent = () => Promise.all(PRIVATE_CACHES.map((name) => caches.delete(name)));
+
+// Open pages were drawn from the cache; sw-register.js reloads them.
+const notifySessionEnded = async () => {
+    const clients = await self.clients.matchAll({ type: 'window' });
+    clients.forEach((client) => client.postMessage({ type: 'session-ended' }));
+};
+
+const network = (request, cacheName, maxEntries) => {
+    const key = request.url;
+    let pending = inFlight.get(key);
+    if (!pending) {
+        // Pages are fetched as a plain same-origin GET rather than as the
+        // navigation itself, so a redirect to the login page can be seen.
+        const shared = cacheName === PAGE_CACHE && request.mode === 'navigate'
+            ? new Request(request.url, { credentials: 'same-origin' })
+            : request;
+        pending = fetch(shared).then(async (response) => {
+            if (PRIVATE_CACHES.includes(cacheName) && sessionEnded(response)) {
+                await forgetStudent();
+            } else if (response.ok && !response.redirected && response.type === 'basic') {
+                await store(cacheName, key, response.clone(), maxEntries);
+            }
+            return response;
+        });
+        inFlight.set(key, pending);
+        pending.catch(() => {}).then(() => inFlight.delete(key));
+    }
+    // Every caller gets its own copy; a navigation must not reuse a response
+    // that was redirected on the way.
+    return pending.then((response) => (
+        response.redirected && request.mode === 'navigate' ? fetch(request) : response.clone()
+    ));
+};
+
+const staleWhileRevalidate = async (event, cacheName, maxEntries) => {
+    const cached = await caches.match(event.request.url, { cacheName });
+    if (!cached) return network(event.request, cacheName, maxEntries);
+    const fetchedAt = Number(cached.headers.get('x-sw-fetched-at')) || 0;
+    if (Date.now() - fetchedAt > FRESH_MS) {
+        event.waitUntil(network(event.request, cacheName, maxEntries).then((response) => {
+            if (PRIVATE_CACHES.includes(cacheName) && sessionEnded(response)) return notifySessionEnded();
+            return undefined;
+        }).catch(() => {}));
+    }
+    return cached;
+};
+
+const cacheFirst = async (event, cacheName, maxEntries) => {
+    const cached = await caches.match(event.request.url, { cacheName });
+    return cached || network(event.request, cacheName, maxEntries);
+};
+
+const offlinePage = () => new Response(
+    '<!DOCTYPE html><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">'
+    + '<title>Offline | EEE LearnHub</title><p style="font-family: sans-serif; padding: 24px;">'
+    + 'You are offline and this page has not been saved yet. Reconnect and try again.</p>',
+    { status: 503, headers: { 'Content-Type': 'text/html; charset=utf-8' } }
+);
+
+self.addEventListener('fetch', (event) => {
+    const { request } = event;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+
+    if (request.method !== 'GET') {
+        // Any write (completing a video, posting a message) can change what
+        // the student pages show, so start them fresh. Logging in may switch
+        // to another student, so their PDFs go too.
+        const stale = LOGIN_PATHS.includes(url.pathname) ? PRIVATE_CACHES : [PAGE_CACHE];
+        event.respondWith(Promise.all(stale.map((name) => caches.delete(name))).then(() => fetch(request)));
+        return;
+    }
+    if (url.pathname === '/logout' || url.pathname === '/admin/logout') {
+        event.respondWith(Promise.all(CACHES.map((name) => caches.delete(name))).then(() => fetch(request)));
+        return;
+    }
+
+    if (url.pathname.startsWith('/static/')) {
+        event.respondWith(staleWhileRevalidate(event, STATIC_CACHE));
+    } else if (url.pathname.startsWith('/files/')) {
+        event.respondWith(cacheFirst(event, FILE_CACHE, MAX_FILES));
+    } else if (PAGE_PATTERN.test(url.pathname) && !url.search) {
+        event.respondWith(staleWhileRevalidate(event, PAGE_CACHE, MAX_PAGES).catch(offlinePage));
+    }
+});
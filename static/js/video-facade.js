@@ -0,0 +1,16 @@
+(() => {
+    const facades = document.querySelectorAll('.video-facade[data-youtube-id]');
+    if (!facades.length) return;
+
+    facades.forEach((facade) => {
+        facade.addEventListener('click', () => {
+            const videoId = facade.getAttribute('data-youtube-id');
+            const iframe = document.createElement('iframe');
+            iframe.src = `https://www.youtube-nocookie.com/embed/${encodeURIComponent(videoId)}?autoplay=1`;
+            iframe.title = facade.getAttribute('aria-label') || 'YouTube video';
+            iframe.allow = 'accelerometer; autoplay; encrypted-media; gyroscope; picture-in-picture';
+            iframe.allowFullscreen = true;
+            facade.replaceWith(iframe);
+        }, { once: true });
+    });
+})();
@@ -0,0 +1,56 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its configuration at import time, so point every path it
+# writes to at a scratch directory before importing it.
+TMP_DIR = tempfile.mkdtemp(prefix='learnhub-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(TMP_DIR, 'learnhub.db')
+os.environ['METRICS_DIR'] = os.path.join(TMP_DIR, 'metrics')
+os.environ['PROFILE_DIR'] = os.path.join(TMP_DIR, 'profiles')
+os.environ['STORAGE_LOCAL_DIR'] = os.path.join(TMP_DIR, 'storage')
+os.environ['SESSION_SQLITE_PATH'] = os.path.join(TMP_DIR, 'sessions.db')
+os.environ['RATE_LIMIT_ENABLED'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as learnhub  # noqa: E402
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    learnhub.ensure_database_initialized()
+    return learnhub
+
+
+@pytest.fixture
+def ctx(app_module):
+    with app_module.app.app_context():
+        yield app_module
+        app_module.db.session.rollback()
+
+
+@pytest.fixture
+def make_user(ctx):
+    def make(name='Student'):
+        n = next(_ids)
+        user = ctx.User(name=f'{name} {n}', email=f'student{n}@example.com', password_hash='x')
+        ctx.db.session.add(user)
+        ctx.db.session.commit()
+        return user
+    return make
+
+
+@pytest.fixture
+def admin_client(app_module):
+    client = app_module.app.test_client()
+    response = client.post('/admin/login', data={
+        'username': app_module.ADMIN_USERNAME,
+        'password': app_module.ADMIN_PASSWORD,
+    })
+    assert response.status_code == 302
+    return client
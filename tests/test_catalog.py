@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+
+
+def current_version(ctx):
+    return ctx.db.session.get(ctx.CatalogVersion, 1).version
+
+
+def entries_after(ctx, version):
+    return ctx.CatalogChange.query.filter(ctx.CatalogChange.version > version).order_by(ctx.CatalogChange.version).all()
+
+
+def add_subject_with_topic(ctx, name):
+    subject = ctx.Subject(name=name)
+    ctx.db.session.add(subject)
+    ctx.db.session.flush()
+    topic = ctx.Topic(name=f'{name} basics', subject_id=subject.id)
+    ctx.db.session.add(topic)
+    ctx.db.session.commit()
+    return subject, topic
+
+
+def test_versions_follow_the_counter_row(ctx):
+    start = current_version(ctx)
+    subject, topic = add_subject_with_topic(ctx, 'Catalog Ordering')
+    topic.name = 'Renamed basics'
+    ctx.db.session.commit()
+
+    entries = entries_after(ctx, start)
+    assert [e.version for e in entries] == list(range(start + 1, start + 4))
+    assert [(e.entity, e.entity_id, e.op) for e in entries] == [
+        ('subject', subject.id, 'upsert'),
+        ('topic', topic.id, 'upsert'),
+        ('topic', topic.id, 'upsert'),
+    ]
+    assert current_version(ctx) == start + 3
+
+
+def test_changes_replay_in_version_order(ctx):
+    start = current_version(ctx)
+    subject, topic = add_subject_with_topic(ctx, 'Catalog Replay')
+    ctx.db.session.delete(topic)
+    ctx.db.session.commit()
+
+    page = ctx.catalog_changes(start)
+
+    assert page['reset'] is False
+    assert page['version'] == current_version(ctx)
+    assert [(c['entity'], c['id'], c['op']) for c in page['changes']] == [
+        ('subject', subject.id, 'upsert'),
+        ('topic', topic.id, 'delete'),
+    ]
+    assert page['changes'][0]['data'] == {'name': 'Catalog Replay'}
+
+
+def test_changes_page_through_the_log(ctx):
+    start = current_version(ctx)
+    add_subject_with_topic(ctx, 'Catalog Paging')
+
+    first = ctx.catalog_changes(start, limit=1)
+    second = ctx.catalog_changes(first['version'], limit=1)
+
+    assert first['has_more'] is True
+    assert first['version'] == start + 1
+    assert second['has_more'] is False
+    assert second['version'] == start + 2
+
+
+def test_compaction_resets_clients_behind_the_horizon(ctx):
+    before = current_version(ctx)
+    subject, topic = add_subject_with_topic(ctx, 'Catalog Compaction')
+    topic.name = 'Compacted basics'
+    ctx.db.session.commit()
+    ctx.db.session.delete(topic)
+    ctx.db.session.commit()
+    ctx.CatalogChange.query.filter_by(entity='topic', entity_id=topic.id).update(
+        {'created_at': datetime.utcnow() - timedelta(days=45)}
+    )
+    ctx.db.session.commit()
+
+    removed = ctx.compact_catalog_changes(30)
+    ctx.db.session.commit()
+
+    assert removed >= 3
+    assert ctx.CatalogChange.query.filter_by(entity='topic', entity_id=topic.id).count() == 0
+    assert ctx.CatalogChange.query.filter_by(entity='subject', entity_id=subject.id).count() == 1
+    horizon = ctx._catalog_horizon()
+    assert horizon > before
+
+    assert ctx.catalog_changes(before)['reset'] is True
+    assert ctx.catalog_changes(horizon)['reset'] is False
+    full = ctx.catalog_changes(0, limit=10000)
+    assert full['reset'] is False
+    assert ('subject', subject.id) in {(c['entity'], c['id']) for c in full['changes']}
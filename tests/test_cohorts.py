@@ -0,0 +1,72 @@
+def visible_titles(ctx, user_id):
+    query = ctx.Notification.query.filter(ctx.visible_notifications_filter(user_id))
+    return {notification.title for notification in query}
+
+
+def make_cohort(ctx, name, members):
+    cohort = ctx.Cohort(name=name)
+    ctx.db.session.add(cohort)
+    ctx.db.session.flush()
+    for user in members:
+        ctx.db.session.add(ctx.CohortMember(cohort_id=cohort.id, user_id=user.id))
+    ctx.db.session.commit()
+    return cohort
+
+
+def test_notifications_reach_only_their_audience(ctx, make_user):
+    member, outsider, direct = make_user(), make_user(), make_user()
+    cohort = make_cohort(ctx, 'Visibility A', [member])
+    ctx.create_notification('vis-all', 'b')
+    ctx.create_notification('vis-cohort', 'b', audience='cohort', cohort_id=cohort.id)
+    ctx.create_notification('vis-users', 'b', audience='users', user_ids=[direct.id])
+    ctx.db.session.commit()
+
+    assert {'vis-all', 'vis-cohort'} <= visible_titles(ctx, member.id)
+    assert 'vis-users' not in visible_titles(ctx, member.id)
+    assert 'vis-cohort' not in visible_titles(ctx, outsider.id)
+    assert {'vis-all', 'vis-users'} <= visible_titles(ctx, direct.id)
+
+
+def test_cohort_events_reach_only_members(ctx, make_user):
+    member, outsider = make_user(), make_user()
+    cohort = make_cohort(ctx, 'Visibility B', [member])
+    start = ctx.db.session.query(ctx.db.func.max(ctx.LiveEvent.id)).scalar() or 0
+    ctx.create_notification('event-cohort', 'b', audience='cohort', cohort_id=cohort.id)
+    ctx.db.session.commit()
+
+    assert [row.kind for row in ctx.visible_events_after(member.id, start)] == ['notification']
+    assert ctx.visible_events_after(outsider.id, start) == []
+
+
+def test_admin_only_sends_cohort_id_for_cohort_audience(ctx, make_user, admin_client):
+    cohort = make_cohort(ctx, 'Audience', [make_user()])
+    admin_client.post('/admin', data={
+        'form_type': 'notification', 'notification_title': 'audience-all',
+        'notification_body': 'b', 'audience': 'all', 'cohort_id': cohort.id,
+    })
+    notification = ctx.Notification.query.filter_by(title='audience-all').one()
+    assert notification.audience == 'all'
+    assert notification.cohort_id is None
+
+
+def test_deleting_cohort_keeps_broadcasts(ctx, make_user, admin_client):
+    member = make_user()
+    cohort = make_cohort(ctx, 'Doomed', [member])
+    cohort_id = cohort.id
+    ctx.create_notification('doomed-cohort', 'b', audience='cohort', cohort_id=cohort_id)
+    # Rows written before the admin form stopped passing the cohort id.
+    stale = ctx.create_notification('doomed-stale-broadcast', 'b')
+    stale.cohort_id = cohort_id
+    ctx.db.session.commit()
+
+    response = admin_client.post(f'/admin/cohorts/{cohort_id}/delete')
+    assert response.status_code == 302
+
+    ctx.db.session.expire_all()
+    assert ctx.db.session.get(ctx.Cohort, cohort_id) is None
+    assert ctx.CohortMember.query.filter_by(cohort_id=cohort_id).count() == 0
+    assert ctx.LiveEvent.query.filter_by(cohort_id=cohort_id).count() == 0
+    assert ctx.Notification.query.filter_by(title='doomed-cohort').count() == 0
+    broadcast = ctx.Notification.query.filter_by(title='doomed-stale-broadcast').one()
+    assert broadcast.cohort_id is None
+    assert 'doomed-stale-broadcast' in visible_titles(ctx, member.id)
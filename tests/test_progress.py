@@ -0,0 +1,84 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+
+@pytest.fixture
+def buffer(ctx, monkeypatch):
+    # Flush by hand instead of from the background thread.
+    monkeypatch.setattr(ctx, 'ensure_progress_flusher', lambda: None)
+    monkeypatch.setattr(ctx, 'progress_buffer', {})
+    monkeypatch.setattr(ctx, 'progress_buffer_size', 0)
+    return ctx
+
+
+@pytest.fixture
+def videos(ctx, request):
+    subject = ctx.Subject(name=f'Buffered {request.node.name}')
+    ctx.db.session.add(subject)
+    ctx.db.session.flush()
+    topic = ctx.Topic(name='Buffered Topic', subject_id=subject.id)
+    ctx.db.session.add(topic)
+    ctx.db.session.flush()
+    rows = [ctx.Video(title=f'Clip {i}', youtube_id=f'clip{i}', topic_id=topic.id) for i in range(3)]
+    ctx.db.session.add_all(rows)
+    ctx.db.session.commit()
+    return [(video.id, topic.id, subject.id) for video in rows]
+
+
+def completed_ids(ctx, user_id):
+    ctx.db.session.expire_all()
+    return {row.video_id for row in ctx.VideoCompletion.query.filter_by(user_id=user_id)}
+
+
+def test_flush_coalesces_clicks(buffer, make_user, videos):
+    user_id = make_user().id
+    (v1, t, s), (v2, _, _), _ = videos
+    buffer.buffer_progress(user_id, [(v1, t, s, True), (v2, t, s, True)])
+    buffer.buffer_progress(user_id, [(v2, t, s, False)])
+    assert buffer.progress_buffer_size == 2
+
+    buffer.flush_progress_buffer()
+
+    assert buffer.progress_buffer == {}
+    assert buffer.progress_buffer_size == 0
+    assert completed_ids(buffer, user_id) == {v1}
+
+
+def test_failed_flush_requeues_without_overwriting_newer_clicks(buffer, make_user, videos, monkeypatch):
+    user_id = make_user().id
+    (v1, t, s), (v2, _, _), _ = videos
+    buffer.buffer_progress(user_id, [(v1, t, s, True), (v2, t, s, True)])
+    apply_events = buffer._apply_progress_events
+
+    def locked(batch):
+        # A newer click lands while the flush is failing.
+        buffer.buffer_progress(user_id, [(v2, t, s, False)])
+        raise OperationalError('INSERT', {}, Exception('database is locked'))
+
+    monkeypatch.setattr(buffer, '_apply_progress_events', locked)
+    buffer.flush_progress_buffer()
+
+    assert completed_ids(buffer, user_id) == set()
+    assert buffer.progress_buffer[user_id] == {v1: (True, t, s), v2: (False, t, s)}
+    assert buffer.progress_buffer_size == 2
+
+    monkeypatch.setattr(buffer, '_apply_progress_events', apply_events)
+    buffer.flush_progress_buffer()
+
+    assert buffer.progress_buffer == {}
+    assert completed_ids(buffer, user_id) == {v1}
+
+
+def test_other_errors_drop_the_batch(buffer, make_user, videos, monkeypatch):
+    user_id = make_user().id
+    (v1, t, s), _, _ = videos
+    buffer.buffer_progress(user_id, [(v1, t, s, True)])
+
+    def broken(batch):
+        raise ValueError('bad event')
+
+    monkeypatch.setattr(buffer, '_apply_progress_events', broken)
+    buffer.flush_progress_buffer()
+
+    assert buffer.progress_buffer == {}
+    assert completed_ids(buffer, user_id) == set()
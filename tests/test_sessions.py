@@ -0,0 +1,75 @@
+import os
+import secrets
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import TMP_DIR
+
+
+@pytest.fixture(params=['database', 'sqlite'])
+def backend(request, ctx):
+    if request.param == 'database':
+        return ctx.DatabaseSessionBackend()
+    return ctx.SqliteSessionBackend(os.path.join(TMP_DIR, 'sessions-test.db'))
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+def test_save_load_touch_delete(backend):
+    sid = new_sid()
+    expires = datetime(2030, 1, 1, 12, 0, 0)
+    assert backend.load(sid) is None
+
+    backend.save(sid, '{"user_id":1}', 1, expires)
+    assert backend.load(sid) == ('{"user_id":1}', expires)
+
+    backend.save(sid, '{"user_id":1,"x":2}', 1, expires)
+    assert backend.load(sid)[0] == '{"user_id":1,"x":2}'
+
+    later = expires + timedelta(days=1)
+    backend.touch(sid, later)
+    assert backend.load(sid)[1] == later
+
+    backend.delete(sid)
+    assert backend.load(sid) is None
+
+
+def test_delete_user_keeps_current_session(backend):
+    expires = datetime(2030, 1, 1)
+    current, other, stranger = new_sid(), new_sid(), new_sid()
+    backend.save(current, '{}', 4242, expires)
+    backend.save(other, '{}', 4242, expires)
+    backend.save(stranger, '{}', 4243, expires)
+
+    backend.delete_user(4242, keep_sid=current)
+
+    assert backend.load(current) is not None
+    assert backend.load(other) is None
+    assert backend.load(stranger) is not None
+
+
+def test_sweep_drops_expired_sessions(backend):
+    now = datetime(2030, 6, 1)
+    expired, live = new_sid(), new_sid()
+    backend.save(expired, '{}', None, now - timedelta(seconds=1))
+    backend.save(live, '{}', None, now + timedelta(days=1))
+
+    backend.sweep(now)
+
+    assert backend.load(expired) is None
+    assert backend.load(live) is not None
+
+
+def test_database_backend_leaves_request_session_alone(ctx, make_user):
+    user_id = make_user().id
+    backend = ctx.DatabaseSessionBackend()
+    ctx.db.session.get(ctx.User, user_id).name = 'Unsaved edit'
+
+    backend.save(new_sid(), '{}', user_id, datetime(2030, 1, 1))
+    backend.delete_user(user_id)
+    ctx.db.session.rollback()
+
+    assert ctx.db.session.get(ctx.User, user_id).name != 'Unsaved edit'